@@ -0,0 +1,139 @@
+import collections
+import hashlib
+import os
+import threading
+import numpy as np
+
+
+class InferenceCache:
+
+    # Network outputs keyed by a hash of the input blob of one image and of whatever else
+    # decides the output (model files, input size). Recent outputs are kept in memory, the
+    # least recently used going first once there are more than `memory` of them. With a
+    # path, outputs are also saved there as .npy files, the least recently used being
+    # deleted once they take more than `disk` bytes. Raw outputs are cached rather than
+    # keypoints, so that decoding can change without invalidating the cache.
+    #
+    # With quantize, the blob is rounded to that many levels before hashing, so frames that
+    # differ only by noise, as often with static cameras, share an entry.
+    #
+    # The files of the disk tier and their sizes are indexed in memory, least recently used
+    # first, from their modification times when the cache is opened. Processes sharing the
+    # path each keep their own index, so the budget is only kept approximately then.
+    def __init__(self, path=None, memory=256, disk=1 << 30, quantize=None):
+        self.path = path
+        self.memory = memory
+        self.disk = disk
+        self.quantize = quantize
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.disk_size = 0
+        self.disk_files = collections.OrderedDict()
+        if path is not None:
+            os.makedirs(path, exist_ok=True)
+            files = sorted((entry.stat().st_mtime, entry.name[:-len('.npy')], entry.stat().st_size)
+                           for entry in os.scandir(path) if entry.name.endswith('.npy'))
+            for (mtime, key, size) in files:
+                self.index(key, size)
+
+    def parameters(self):
+        # Enough to build the same cache, e.g. in another process, sharing the disk tier.
+        return (self.path, self.memory, self.disk, self.quantize)
+
+    def __repr__(self):
+        return f'InferenceCache({self.path.__repr__()}, memory={self.memory}, disk={self.disk}, quantize={self.quantize})'
+
+    def key(self, blob, parameters=()):
+        # blob is the (C, H, W) input of a single image.
+        if self.quantize is not None:
+            blob = np.rint(np.asarray(blob) * self.quantize).astype(np.int32)
+        blob = np.ascontiguousarray(blob)
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(repr((parameters, self.quantize, blob.shape, blob.dtype.str)).encode())
+        digest.update(blob.data)
+        return digest.hexdigest()
+
+    def get(self, key):
+        # The cached output, or None.
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return value
+        if self.path is not None:
+            file = os.path.join(self.path, key + '.npy')
+            try:
+                value = np.load(file)
+                os.utime(file)
+                size = os.path.getsize(file)
+            except (OSError, ValueError):
+                value = None
+            if value is not None:
+                with self.lock:
+                    self.disk_hits += 1
+                    self.remember(key, value)
+                    self.index(key, size)
+                return value
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, value):
+        value = np.array(value)
+        with self.lock:
+            self.remember(key, value)
+        if self.path is not None:
+            file = os.path.join(self.path, key + '.npy')
+            temporary = f'{file}.{os.getpid()}.{threading.get_ident()}.tmp'
+            with open(temporary, 'wb') as stream:
+                np.save(stream, value)
+            os.replace(temporary, file)
+            size = os.path.getsize(file)
+            with self.lock:
+                self.index(key, size)
+                if self.disk_size > self.disk:
+                    self.evict()
+
+    def remember(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.memory:
+            self.entries.popitem(last=False)
+
+    def files(self):
+        return [entry.path for entry in os.scandir(self.path) if entry.name.endswith('.npy')]
+
+    def index(self, key, size):
+        # Records the file of key as the most recently used one of the disk tier.
+        self.disk_size += size - self.disk_files.pop(key, 0)
+        self.disk_files[key] = size
+
+    def evict(self):
+        # Deletes the least recently used files until the disk tier fits in its budget.
+        # Files already gone, e.g. evicted by another process, are just forgotten.
+        while self.disk_size > self.disk and self.disk_files:
+            (key, size) = self.disk_files.popitem(last=False)
+            self.disk_size -= size
+            try:
+                os.remove(os.path.join(self.path, key + '.npy'))
+            except OSError:
+                pass
+
+    def stats(self):
+        lookups = self.hits + self.disk_hits + self.misses
+        return {'hits': self.hits, 'disk_hits': self.disk_hits, 'misses': self.misses,
+                'hit_rate': (self.hits + self.disk_hits) / lookups if lookups else 0.0,
+                'entries': len(self.entries), 'disk_size': self.disk_size}
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            if self.path is not None:
+                for file in self.files():
+                    os.remove(file)
+                self.disk_files.clear()
+                self.disk_size = 0
@@ -1,7 +1,19 @@
+import collections
+import contextlib
 import cv2
 import glob
+import inspect
+import itertools
+import multiprocessing
+import os
+import threading
 from pose_description import *
 from pose_estimation import *
+from pose_library import IncrementalEvaluator, PoseLibrary
+from pose_pipeline import Pipeline, Stage
+from pose_store import SkeletonStore
+from pose_tracking import KeyframeEstimator
+from pose_temporal import PoseStream
 
 TPOSE = Body.left_arm.to_the_right(Body.left_shoulder) & Body.right_arm.to_the_left(Body.right_shoulder)
 DABR = Body.right_arm.to_the_left(Body.right_shoulder) & Body.left_wrist.to_the_left(Body.head)
@@ -13,6 +25,7 @@ POSE4 = Body.left_forearm.above(Body.head) & Body.right_arm.below(Body.head) & B
 
 
 POSES = {POSE1: "Both hands raised", POSE2: "Right hand raised, left arm extended", POSE3: "Knee raised", POSE4: "Left hand raised, right arm extended", TPOSE: "T-pose", DABR: "Dabbing right", DABL: "Dabbing left"}
+LIBRARY = PoseLibrary(POSES)
 
 def vid_to_frames(vidPath='demo.mp4', framePath='VidFrames/Raw/demo_frame'):
     video = cv2.VideoCapture(vidPath)
@@ -27,59 +40,301 @@ def vid_to_frames(vidPath='demo.mp4', framePath='VidFrames/Raw/demo_frame'):
     return (length, fps)
 
 
-def frames_to_vid(fps, vidPath='demo_poses.mp4', framePath='VidFrames/Treated/demo_frame'):
-    done = False
+def read_frame_files(framePath='VidFrames/Treated/demo_frame'):
     i = 0
-    frames = []
-    while not done:
-            image = cv2.imread(f'{framePath}{i}.jpg')
-            if image is None:
-                done = True
-            else:
-                height, width, layers = image.shape
-                size = (width, height)
-                frames.append(image)
-                i += 1
-
-    out = cv2.VideoWriter(vidPath, cv2.VideoWriter_fourcc(*'DIVX'), fps, size)
+    image = cv2.imread(f'{framePath}{i}.jpg')
+    while image is not None:
+        yield image
+        i += 1
+        image = cv2.imread(f'{framePath}{i}.jpg')
+
 
+def frames_to_vid(fps, vidPath='demo_poses.mp4', framePath='VidFrames/Treated/demo_frame', fourcc='DIVX'):
+    # framePath is either the path prefix of numbered frame files or an iterable of frames.
+    # The writer is opened once the first frame gives the video size and every frame is
+    # written as soon as it arrives, so only one frame is held in memory at a time.
+    frames = read_frame_files(framePath) if isinstance(framePath, str) else framePath
+    out = None
     k = 0
-    for j in frames:
-        out.write(j)
+    for image in frames:
+        if out is None:
+            height, width, layers = image.shape
+            size = (width, height)
+            out = cv2.VideoWriter(vidPath, cv2.VideoWriter_fourcc(*fourcc), fps, size)
+        out.write(image)
         print(f'Frame {k} added to {size[0]}x{size[1]} @ {int(fps)}FPS video.')
         k += 1
-    out.release()
+    if out is not None:
+        out.release()
+    return k
+
+
+def score_poses(skeleton, evaluator=LIBRARY):
+    scores = evaluator.scores(skeleton)
+    bestPoseId = max(scores, key=scores.get)
+    return (scores, bestPoseId)
 
 
-def frame_treatment(framePath, resultPath):
-    (skeleton, frame) = pose_estimation(framePath, True)
+def render_scores(frame, scores, bestPoseId):
     height, width, layers = frame.shape
-    bestPoseId = list(POSES.keys())[0]
-    for pose in POSES.keys():
-        bestPoseId = pose if pose(skeleton) > bestPoseId(skeleton) else bestPoseId
-        
     font = cv2.FONT_HERSHEY_SIMPLEX
     frame = cv2.copyMakeBorder(frame, 0, 0, 0, 1000, cv2.BORDER_CONSTANT, value=[255, 255, 255])
     i = 0
     for key in POSES.keys():
         i += 1
         if key == bestPoseId:
-            cv2.putText(frame, f'{POSES[key]}: {key(skeleton)}', (width + 24, 50*i), font, 1, (255, 0, 255), 2)
+            cv2.putText(frame, f'{POSES[key]}: {scores[key]}', (width + 24, 50*i), font, 1, (255, 0, 255), 2)
         else:
-            cv2.putText(frame, f'{POSES[key]}: {key(skeleton)}', (width + 24, 50*i), font, 1, (0, 0, 0), 2)
-        
-    cv2.imwrite(resultPath, frame)
+            cv2.putText(frame, f'{POSES[key]}: {scores[key]}', (width + 24, 50*i), font, 1, (0, 0, 0), 2)
+    return frame
 
 
+def frame_treatment(framePath, resultPath, estimator=None):
+    if estimator is None:
+        estimator = shared_estimator()
+    (skeleton, frame) = estimator.estimate_path(framePath, True)
+    (scores, bestPoseId) = score_poses(skeleton)
+    cv2.imwrite(resultPath, render_scores(frame, scores, bestPoseId))
 
-def demo(vidPath='demo.mp4',demoPath='demo_pose.mp4', tempFrames='VidFrames/Raw/demo_frame', treatedFrames='VidFrames/Treated/demo_frame'):
-    (length, framerate) = vid_to_frames(vidPath, tempFrames)
-    for i in range(length):
-        try:
-            frame_treatment(f'{tempFrames}{i}.jpg', f'{treatedFrames}{i}.jpg')
-            print(f'Frame {i} successfully processed.')
-        except TypeError:
-            print(f'Frame {i} processing failed. Adding non processed framed to video anyway.')
-            cv2.imwrite(f'{treatedFrames}{i}.jpg',cv2.copyMakeBorder(cv2.imread(f'{tempFrames}{i}.jpg'), 0, 0, 0, 1000, cv2.BORDER_CONSTANT, value=[255, 255, 255]))
-    frames_to_vid(framerate, demoPath, treatedFrames)
-    
+
+# Streaming pipeline: every stage is a generator over frames kept in memory as arrays, so
+# a video is decoded, estimated, classified, rendered and encoded in a single pass. The
+# framePath arguments optionally dump the intermediate frames to disk for debugging.
+
+def video_framerate(vidPath, default=30):
+    # Frame rate of the video, or default when the capture does not report one.
+    video = cv2.VideoCapture(vidPath)
+    framerate = video.get(cv2.CAP_PROP_FPS)
+    video.release()
+    return framerate if framerate > 0 else default
+
+
+def read_frames(vidPath='demo.mp4', framePath=None):
+    video = cv2.VideoCapture(vidPath)
+    i = 0
+    (retFrame, frame) = video.read()
+    while retFrame:
+        if framePath is not None:
+            cv2.imwrite(f'{framePath}{i}.jpg', frame)
+        yield frame
+        i += 1
+        (retFrame, frame) = video.read()
+    video.release()
+
+
+def estimate_frame(frame, estimator):
+    (skeleton, drawn, conf) = estimator.estimate(frame, True, True)
+    return (frame, skeleton, drawn, conf)
+
+
+def estimate_frames(frames, estimator):
+    for frame in frames:
+        yield estimate_frame(frame, estimator)
+
+
+def classify_frame(estimated, i, evaluator=LIBRARY):
+    (frame, skeleton, drawn, conf) = estimated
+    try:
+        (scores, bestPoseId) = score_poses(skeleton, evaluator)
+        print(f'Frame {i} successfully processed.')
+    except TypeError:
+        print(f'Frame {i} processing failed. Adding non processed framed to video anyway.')
+        (scores, bestPoseId) = (None, None)
+    return (frame, skeleton, drawn, conf, scores, bestPoseId)
+
+
+def classify_frames(estimated, start=0, epsilon=0):
+    # Consecutive frames are scored incrementally, only re-scoring what moving joints change.
+    evaluator = IncrementalEvaluator(LIBRARY, epsilon)
+    for (i, frame) in enumerate(estimated, start):
+        yield classify_frame(frame, i, evaluator)
+
+
+def record_results(classified, results):
+    for (frame, skeleton, drawn, conf, scores, bestPoseId) in classified:
+        results.append((Skeleton.from_dict(skeleton), scores))
+        yield (frame, skeleton, drawn, conf, scores, bestPoseId)
+
+
+def store_results(classified, store, framerate, start=0):
+    # Appends the skeleton and joint confidences of every frame to a SkeletonStore as the
+    # frames go by.
+    for (i, item) in enumerate(classified, start):
+        store.append(i, i / framerate, item[1], item[3])
+        yield item
+
+
+def render_frame(classified, framePath=None, i=0):
+    (frame, skeleton, drawn, conf, scores, bestPoseId) = classified
+    if scores is None:
+        rendered = cv2.copyMakeBorder(frame, 0, 0, 0, 1000, cv2.BORDER_CONSTANT, value=[255, 255, 255])
+    else:
+        rendered = render_scores(drawn, scores, bestPoseId)
+    if framePath is not None:
+        cv2.imwrite(f'{framePath}{i}.jpg', rendered)
+    return rendered
+
+
+def render_frames(classified, framePath=None, start=0):
+    for (i, frame) in enumerate(classified, start):
+        yield render_frame(frame, framePath, i)
+
+
+def threaded_demo(vidPath='demo.mp4', demoPath='demo_pose.mp4', threads=None, tempFrames=None, treatedFrames=None, estimator=None, queueSize=8, joints=None, store=None):
+    # Decoding runs in the pipeline's feeder thread and encoding in the calling thread, while
+    # estimation, classification and rendering each get their own pool of threads. An
+    # estimator is not thread safe, so extra estimation threads load their own network,
+    # sharing the cache of the first one.
+    # Results come out in frame order, and go to the SkeletonStore store if there is one.
+    threads = {'estimate': 1, 'classify': 1, 'render': 1, **(threads or {})}
+    if estimator is None:
+        estimator = PoseEstimator(joints=joints)
+    local = threading.local()
+    created = []
+    lock = threading.Lock()
+
+    def estimate(job):
+        (i, frame) = job
+        if not hasattr(local, 'estimator'):
+            with lock:
+                local.estimator = PoseEstimator(*estimator.parameters()[:-1], estimator.cache) if created else estimator
+                created.append(local.estimator)
+        return (i, estimate_frame(frame, local.estimator))
+
+    def classify(job):
+        (i, estimated) = job
+        return (i, classify_frame(estimated, i))
+
+    def render(job):
+        (i, classified) = job
+        (frame, skeleton, drawn, conf, scores, bestPoseId) = classified
+        return (render_frame(classified, treatedFrames, i), (Skeleton.from_dict(skeleton), scores), conf)
+
+    pipeline = Pipeline([Stage('estimate', estimate, threads['estimate'], queueSize),
+                         Stage('classify', classify, threads['classify'], queueSize),
+                         Stage('render', render, threads['render'], queueSize)], queueSize)
+
+    framerate = video_framerate(vidPath)
+    results = []
+
+    def rendered():
+        for (frame, result, conf) in pipeline.run(enumerate(read_frames(vidPath, tempFrames))):
+            if store is not None:
+                store.append(len(results), len(results) / framerate, result[0], conf)
+            results.append(result)
+            yield frame
+
+    frames_to_vid(framerate, demoPath, rendered())
+    for (name, metrics) in pipeline.metrics().items():
+        print(f'Stage {name}: {metrics["processed"]} frames on {metrics["threads"]} threads, '
+              f'{metrics["busy"]:.2f}s busy, queue depth {metrics["mean_depth"]:.1f} mean / {metrics["max_depth"]} max.')
+    return results
+
+
+def chunk_treatment(frames, start, estimatorParameters, treatedFrames=None, joints=None, estimatorFactory=shared_estimator):
+    # Runs in a worker process: each worker loads its own network once and treats the
+    # chunks of frames it is sent, starting at frame `start`. The annotated frames are sent
+    # back in memory along with the results. estimatorParameters are PoseEstimator
+    # arguments, as given by PoseEstimator.parameters(); joints, if given, replaces theirs.
+    cv2.setNumThreads(1)
+    parameters = inspect.signature(PoseEstimator).bind_partial(*estimatorParameters).arguments
+    if joints is not None:
+        parameters['joints'] = joints
+    estimator = estimatorFactory(**parameters)
+    # Scores are sent back as a list in POSES order, which is lighter to pickle than a dict.
+    poses = list(POSES.keys())
+    treated = []
+    for (i, classified) in enumerate(classify_frames(estimate_frames(frames, estimator), start), start):
+        (frame, skeleton, drawn, conf, scores, bestPoseId) = classified
+        treated.append((render_frame(classified, treatedFrames, i), Skeleton.from_dict(skeleton), conf,
+                        None if scores is None else [scores[pose] for pose in poses]))
+    return treated
+
+
+def frame_chunks(frames, size):
+    # Consecutive (start, frames) chunks of at most size frames.
+    start = 0
+    chunk = list(itertools.islice(frames, size))
+    while chunk:
+        yield (start, chunk)
+        start += len(chunk)
+        chunk = list(itertools.islice(frames, size))
+
+
+def parallel_demo(vidPath='demo.mp4', demoPath='demo_pose.mp4', workers=None, tempFrames=None, treatedFrames=None, estimatorParameters=(), chunkSize=16, joints=None, store=None, estimatorFactory=shared_estimator):
+    # The video is decoded in order in this process and its frames are sent to the workers
+    # in chunks of chunkSize frames, at most two chunks per worker being in flight at once.
+    # Chunks come back in frame order and their annotated frames are encoded only once,
+    # their results going to the SkeletonStore store if there is one. Workers build their
+    # estimator with estimatorFactory, a module-level function so that it can be pickled.
+    workers = workers or os.cpu_count()
+    framerate = video_framerate(vidPath)
+    poses = list(POSES.keys())
+    results = []
+
+    def collect(chunk):
+        for (frame, skeleton, conf, scores) in chunk:
+            if store is not None:
+                store.append(len(results), len(results) / framerate, skeleton, conf)
+            results.append((skeleton, None if scores is None else dict(zip(poses, scores))))
+            yield frame
+
+    def rendered():
+        with multiprocessing.get_context('spawn').Pool(workers) as pool:
+            pending = collections.deque()
+            for (start, frames) in frame_chunks(read_frames(vidPath, tempFrames), chunkSize):
+                pending.append(pool.apply_async(chunk_treatment, (frames, start, estimatorParameters, treatedFrames, joints, estimatorFactory)))
+                if len(pending) >= 2 * workers:
+                    yield from collect(pending.popleft().get())
+            while pending:
+                yield from collect(pending.popleft().get())
+
+    frames_to_vid(framerate, demoPath, rendered())
+    return results
+
+
+def demo(vidPath='demo.mp4',demoPath='demo_pose.mp4', tempFrames=None, treatedFrames=None, estimator=None, workers=1, threads=None, storePath=None, keyframes=None, joints=None):
+    # Returns the skeleton and the pose scores of every frame, in frame order. With
+    # storePath, the skeletons are also kept in a SkeletonStore, to score new poses later
+    # without running the network again. keyframes holds KeyframeEstimator options, e.g.
+    # {'stride': 5}, to run the network on keyframes only and track joints in between.
+    # When no estimator is given, the one the demo builds decodes every joint, or only
+    # those in joints, e.g. LIBRARY.joint_ids, the others then being neither kept nor drawn.
+    # With storePath, joints is refused, whether given here or to the estimator.
+    if storePath is not None:
+        # A store is for scoring poses added later, which may read any joint.
+        decoder = estimator.estimator if isinstance(estimator, KeyframeEstimator) else estimator
+        if joints is not None or (decoder is not None and decoder.joints is not None):
+            raise ValueError('A skeleton store needs an estimator decoding every joint')
+    if keyframes is not None:
+        if workers > 1 or (threads or {}).get('estimate', 1) > 1:
+            raise ValueError('Keyframe estimation needs the frames in order, on a single estimation thread')
+        estimator = KeyframeEstimator(PoseEstimator(joints=joints) if estimator is None else estimator, **keyframes)
+    with contextlib.ExitStack() as stack:
+        store = None if storePath is None else stack.enter_context(SkeletonStore(storePath))
+        if threads is not None:
+            return threaded_demo(vidPath, demoPath, threads, tempFrames, treatedFrames, estimator, joints=joints, store=store)
+        if workers > 1 and estimator is None:
+            return parallel_demo(vidPath, demoPath, workers, tempFrames, treatedFrames, joints=joints, store=store)
+        if workers > 1:
+            return parallel_demo(vidPath, demoPath, workers, tempFrames, treatedFrames, estimator.parameters(), store=store)
+        if estimator is None:
+            estimator = PoseEstimator(joints=joints)
+        framerate = video_framerate(vidPath)
+        results = []
+        classified = record_results(classify_frames(estimate_frames(read_frames(vidPath, tempFrames), estimator)), results)
+        if store is not None:
+            classified = store_results(classified, store, framerate)
+        frames_to_vid(framerate, demoPath, render_frames(classified, treatedFrames))
+    return results
+
+
+def pose_events(results, stream=None):
+    # Replays the (skeleton, scores) results of demo through a PoseStream, so consumers get
+    # the frames where poses start and end instead of polling every frame's scores.
+    stream = PoseStream(LIBRARY) if stream is None else stream
+    poses = stream.library.poses
+    events = []
+    for (skeleton, scores) in results:
+        events.extend(stream.update_scores(None if scores is None else [scores[pose] for pose in poses]))
+    return events
@@ -1,11 +1,50 @@
+import contextlib
 import cv2
+import functools
 import math
+import time
+import weakref
+import numpy as np
 
 from typing import List
 
 
 EPSILON = 0.0001
 
+# Joint ids of each network's skeleton format, in the order of its heatmaps. This is also
+# the column order of the (N, J, 2) coordinate arrays used by compiled poses.
+MPI_JOINTS = ['head', 'neck', 'rshoulder', 'relbow', 'rwrist', 'lshoulder', 'lelbow', 'lwrist',
+              'rhip', 'rknee', 'rankle', 'lhip', 'lknee', 'lankle', 'chest']
+COCO_JOINTS = ['nose', 'neck', 'rshoulder', 'relbow', 'rwrist', 'lshoulder', 'lelbow', 'lwrist',
+               'rhip', 'rknee', 'rankle', 'lhip', 'lknee', 'lankle', 'reye', 'leye', 'rear', 'lear']
+BODY_25_JOINTS = ['nose', 'neck', 'rshoulder', 'relbow', 'rwrist', 'lshoulder', 'lelbow', 'lwrist',
+                  'midhip', 'rhip', 'rknee', 'rankle', 'lhip', 'lknee', 'lankle', 'reye', 'leye',
+                  'rear', 'lear', 'lbigtoe', 'lsmalltoe', 'lheel', 'rbigtoe', 'rsmalltoe', 'rheel']
+
+
+class SkeletonFormat:
+
+    __slots__ = ('name', 'joints', 'index')
+
+    def __init__(self, name: str, joints: List[str]):
+        self.name = name
+        self.joints = joints
+        self.index = {joint: i for i, joint in enumerate(joints)}
+
+    def __repr__(self):
+        return f'SkeletonFormat({self.name.__repr__()})'
+
+    def __reduce__(self):
+        return (skeleton_format, (self.name,))
+
+
+FORMATS = {'MPI': SkeletonFormat('MPI', MPI_JOINTS),
+           'COCO': SkeletonFormat('COCO', COCO_JOINTS),
+           'BODY_25': SkeletonFormat('BODY_25', BODY_25_JOINTS)}
+
+def skeleton_format(name):
+    return FORMATS[name]
+
 
 def fuzzyLog(x: float) -> float:
     return max(0, min(1, x))
@@ -19,130 +58,846 @@ def relative_diff(coord_list, operand, first):
         return fuzzyLog((maxi - operand) / (maxi - mini + EPSILON))
 
 
+# Array counterparts of the Joint/Segment/Limb relations. lo/hi are the (N,) extents of each
+# operand along one axis, and the *_joint flags mirror the `type(other) == Joint` checks.
+
+def batch_fuzzyLog(x):
+    return np.clip(x, 0, 1)
+
+# Rows missing a joint a leaf reads score NaN, where scoring the skeleton alone raises a
+# TypeError. AndPose/OrPose follow their scalar short-circuits, so a row scores NaN exactly
+# when the scalar path raises.
+
+def batch_and(first, second):
+    return np.where(first <= 0, first, np.minimum(first, second))
+
+def batch_or(first, second):
+    return np.where(first >= 1, first, np.maximum(first, second))
+
+def batch_missing(coords, cols):
+    # (N,) mask of the rows missing any of the joints in cols
+    return np.isnan(coords[:, cols]).any(axis=(1, 2))
+
+def lower_rows(pose, index):
+    # Fallback for poses without array kernels: every row is turned back into a skeleton
+    # dict and scored on its own.
+    def rows(coords, scale):
+        scores = []
+        for row in coords:
+            skeleton = {joint: None if np.isnan(row[col]).any() else tuple(row[col].tolist())
+                        for joint, col in index.items()}
+            try:
+                scores.append(pose.evaluate(skeleton))
+            except TypeError:
+                scores.append(np.nan)
+        return np.array(scores, dtype=float)
+    return rows
+
+def batch_precedes(lo_a, hi_a, a_joint, lo_b, hi_b, b_joint):
+    # above on the y axis, to_the_left on the x axis
+    if a_joint and b_joint:
+        return (lo_a < lo_b).astype(float)
+    if a_joint:
+        return batch_fuzzyLog((hi_b - lo_a) / (hi_b - lo_b + EPSILON))
+    return batch_fuzzyLog((lo_b - lo_a) / (hi_a - lo_a + EPSILON))
+
+def batch_follows(lo_a, hi_a, a_joint, lo_b, hi_b, b_joint):
+    # below on the y axis, to_the_right on the x axis
+    if a_joint and b_joint:
+        return (hi_a > hi_b).astype(float)
+    if a_joint:
+        return batch_fuzzyLog((hi_a - lo_b) / (hi_b - lo_b + EPSILON))
+    return batch_fuzzyLog((hi_a - hi_b) / (hi_a - lo_a + EPSILON))
+
+def relation_pairs(lo_a, hi_a, a_joint, lo_b, hi_b, b_joint, precedes):
+    # batch_precedes/batch_follows for many pairs of entities at once: the extents are
+    # (..., L) arrays, each pair on its own axis, and a_joint, b_joint and precedes are (L,)
+    # masks. Pairs involving a missing joint are NaN.
+    with np.errstate(invalid='ignore'):
+        crisp = np.where(precedes, lo_a < lo_b, hi_a > hi_b)
+        towards = np.where(precedes, hi_b - lo_a, hi_a - lo_b) / (hi_b - lo_b + EPSILON)
+        away = np.where(precedes, lo_b - lo_a, hi_a - hi_b) / (hi_a - lo_a + EPSILON)
+    values = np.where(a_joint & b_joint, crisp, np.where(a_joint, batch_fuzzyLog(towards), batch_fuzzyLog(away)))
+    return np.where(np.isnan(lo_a) | np.isnan(lo_b), np.nan, values)
+
+# Geometry kernels of is_near, is_far, at_same_height, at_same_width, aligned_with,
+# points_to, crosses and parallel. a and b are the (..., K, 2) points of each operand, for a
+# single skeleton or a batch, and distances are divided by the (...) body scale. A segment
+# has one bone and a limb two, between consecutive joints. The methods of the same names on
+# Joint, Segment and Limb score two parts with these kernels, given the body scale of their
+# skeleton (see body_scale); points_to, crosses and parallel only compare directions and
+# need none.
+NEAR = 0.25                    # body scales, fully near below, not near at all beyond FAR
+FAR = 1.0
+LEVEL = 0.25                   # offset from the same height/width or line that still scores
+POINTING = math.radians(30)    # angle off the target that still scores for points_to
+PARALLEL = math.radians(20)    # angle between bones that still scores for parallel
+
+def batch_distance(a, b, scale):
+    # smallest distance between a joint of a and a joint of b
+    return np.sqrt(((a[..., :, None, :] - b[..., None, :, :]) ** 2).sum(axis=-1)).min(axis=(-2, -1)) / scale
+
+def batch_near(a, b, scale):
+    return batch_fuzzyLog((FAR - batch_distance(a, b, scale)) / (FAR - NEAR))
+
+def batch_far(a, b, scale):
+    return batch_fuzzyLog((batch_distance(a, b, scale) - NEAR) / (FAR - NEAR))
+
+def batch_level(a, b, scale, axis):
+    offset = np.abs(a[..., axis].mean(axis=-1) - b[..., axis].mean(axis=-1)) / scale
+    return batch_fuzzyLog(1 - offset / LEVEL)
+
+def batch_same_height(a, b, scale):
+    return batch_level(a, b, scale, 1)
+
+def batch_same_width(a, b, scale):
+    return batch_level(a, b, scale, 0)
+
+def batch_cross(u, v):
+    return u[..., 0] * v[..., 1] - u[..., 1] * v[..., 0]
+
+def batch_aligned(a, b, scale):
+    # every joint of one operand on the line through the ends of the other, or two joints
+    # on the same horizontal or vertical line
+    if b.shape[-2] == 1:
+        (a, b) = (b, a)
+    if b.shape[-2] == 1:
+        offset = np.abs(a[..., 0, :] - b[..., 0, :]).min(axis=-1)
+    else:
+        direction = b[..., -1, :] - b[..., 0, :]
+        length = np.sqrt((direction ** 2).sum(axis=-1)) + EPSILON
+        offset = np.abs(batch_cross(direction[..., None, :], a - b[..., :1, :])).max(axis=-1) / length
+    return batch_fuzzyLog(1 - offset / scale / LEVEL)
+
+def batch_angle(u, v, absolute=False):
+    cos = (u * v).sum(axis=-1) / (np.sqrt((u ** 2).sum(axis=-1) * (v ** 2).sum(axis=-1)) + EPSILON)
+    return np.arccos(np.clip(np.abs(cos) if absolute else cos, -1, 1))
+
+def batch_points_to(a, b, scale):
+    # the ray from the end of a farthest from b through its nearest end heads for the
+    # middle of b
+    target = b.mean(axis=-2)
+    (first, last) = (a[..., 0, :], a[..., -1, :])
+    nearer = (((first - target) ** 2).sum(axis=-1) < ((last - target) ** 2).sum(axis=-1))[..., None]
+    (tip, base) = (np.where(nearer, first, last), np.where(nearer, last, first))
+    return batch_fuzzyLog(1 - batch_angle(tip - base, target - tip) / POINTING)
+
+def batch_parallel(a, b, scale):
+    # every bone of a parallel to every bone of b, so a limb is parallel to itself when
+    # straight
+    bones_a = (a[..., 1:, :] - a[..., :-1, :])[..., :, None, :]
+    bones_b = (b[..., 1:, :] - b[..., :-1, :])[..., None, :, :]
+    return batch_fuzzyLog(1 - batch_angle(bones_a, bones_b, True).max(axis=(-2, -1)) / PARALLEL)
+
+def batch_crosses(a, b, scale):
+    # some bone of a properly intersects some bone of b, bones sharing a joint do not cross
+    (a1, a2) = (a[..., :-1, None, :], a[..., 1:, None, :])
+    (b1, b2) = (b[..., None, :-1, :], b[..., None, 1:, :])
+    sides_a = batch_cross(b2 - b1, a1 - b1) * batch_cross(b2 - b1, a2 - b1)
+    sides_b = batch_cross(a2 - a1, b1 - a1) * batch_cross(a2 - a1, b2 - a1)
+    return ((sides_a < 0) & (sides_b < 0)).any(axis=(-2, -1)).astype(float)
+
+def part_points(part):
+    return np.array([(joint.x, joint.y) for joint in part.to_joint_list()], dtype=float)
+
+def part_relation(kernel, part, other, scale):
+    # scalar evaluation of a geometry kernel between two Joint/Segment/Limb objects
+    return float(kernel(part_points(part), part_points(other), scale))
+
+SCALE_JOINTS = frozenset(('neck', 'rhip', 'lhip'))
+
+def body_scale(skeleton):
+    # Distance from the neck to the middle of the hips, the unit of the geometry kernels.
+    if isinstance(skeleton, EvaluationContext):
+        return skeleton.body_scale()
+    (nx, ny) = skeleton['neck']
+    (rx, ry) = skeleton['rhip']
+    (lx, ly) = skeleton['lhip']
+    (dx, dy) = ((rx + lx) / 2 - nx, (ry + ly) / 2 - ny)
+    return max(math.sqrt(dx * dx + dy * dy), EPSILON)
+
+def batch_body_scale(coords, index):
+    hips = (coords[:, index['rhip']] + coords[:, index['lhip']]) / 2
+    return np.maximum(np.sqrt(((hips - coords[:, index['neck']]) ** 2).sum(axis=-1)), EPSILON)
+
+def lower_geometry(first, second, index, kernel):
+    cols_a = first.columns(index)
+    cols_b = second.columns(index)
+    cols = cols_a + cols_b + [index[joint] for joint in sorted(SCALE_JOINTS)]
+
+    def relation(coords, scale):
+        with np.errstate(invalid='ignore'):
+            values = kernel(coords[:, cols_a], coords[:, cols_b], scale)
+        return np.where(batch_missing(coords, cols), np.nan, values)
+    return relation
+
+def lower_relation(first, second, index, kernel, axis):
+    cols_a = first.columns(index)
+    cols_b = second.columns(index)
+    a_joint = isinstance(first, JointSelector)
+    b_joint = isinstance(second, JointSelector)
+
+    def relation(coords, scale):
+        a = coords[:, cols_a, axis]
+        b = coords[:, cols_b, axis]
+        values = kernel(a.min(axis=1), a.max(axis=1), a_joint, b.min(axis=1), b.max(axis=1), b_joint)
+        return np.where(batch_missing(coords, cols_a + cols_b), np.nan, values)
+    return relation
+
+def skeletons_to_array(skeletons, joints=MPI_JOINTS):
+    coords = np.full((len(skeletons), len(joints), 2), np.nan)
+    for i, skeleton in enumerate(skeletons):
+        if isinstance(skeleton, Skeleton) and skeleton.format.joints == joints:
+            coords[i] = skeleton.coords
+            continue
+        for j, joint in enumerate(joints):
+            point = skeleton.get(joint)
+            if point is not None:
+                coords[i, j] = point
+    return coords
+
+def reorder_operands(pose, skeletons):
+    # Returns an equivalent pose where the operands of every AndPose/OrPose are swapped when
+    # the sample skeletons show that evaluating the second one first is cheaper on average,
+    # given how costly each operand is and how often it decides the result on its own.
+    if isinstance(pose, NotPose):
+        return NotPose(reorder_operands(pose.pose, skeletons))
+    if not isinstance(pose, (AndPose, OrPose)):
+        return pose
+    first = reorder_operands(pose.first, skeletons)
+    second = reorder_operands(pose.second, skeletons)
+    decisive = 0 if isinstance(pose, AndPose) else 1
+    (first_cost, first_decides) = profile_operand(first, skeletons, decisive)
+    (second_cost, second_decides) = profile_operand(second, skeletons, decisive)
+    if second_cost + (1 - second_decides) * first_cost < first_cost + (1 - first_decides) * second_cost:
+        (first, second) = (second, first)
+    return type(pose)(first, second)
+
+def profile_operand(pose, skeletons, decisive):
+    # Mean evaluation time of the pose and the share of skeletons where it scores `decisive`.
+    cost = 0
+    decides = 0
+    count = 0
+    for skeleton in skeletons:
+        start = time.perf_counter()
+        try:
+            score = pose(skeleton)
+        except TypeError:
+            continue
+        cost += time.perf_counter() - start
+        decides += score == decisive
+        count += 1
+    return (cost / count, decides / count) if count else (0, 0)
+
+def compile_pose(pose, joints=MPI_JOINTS):
+    # Lowers the pose tree once into nested array kernels. The returned function maps an
+    # (N, J, 2) array of (x, y) coordinates, columns ordered as `joints`, to (N,) scores.
+    # Lowered kernels take the coordinates and the (N,) body scales, which are computed
+    # once per call for all the geometry leaves, or None when there are none.
+    index = {joint: i for i, joint in enumerate(joints)}
+    kernel = pose.lower(index)
+
+    def compiled(coords):
+        coords = np.asarray(coords, dtype=float)
+        return kernel(coords, batch_body_scale(coords, index) if pose.scales else None)
+    return compiled
+
+
+
+# Every Pose and Selector is hash-consed: building a node equal to a live one returns that
+# node, so structurally identical trees share their subtrees, and equality and hashing are
+# structural. Nodes are keyed by their class and operands.
+INTERNED = weakref.WeakValueDictionary()
+
+class ScalarCodegen:
+
+    # Writes the body of a flat Python function scoring one skeleton: coordinates are read
+    # straight from the skeleton into locals, relations are inlined arithmetic and the
+    # AndPose/OrPose short-circuits become if/else blocks. Joints and node values computed
+    # in a block are reused by everything that follows in that block.
+    def __init__(self):
+        self.lines = []
+        self.depth = 1
+        self.known = {}
+        self.constants = {}
+        self.count = 0
+
+    def new(self, prefix):
+        self.count += 1
+        return f'{prefix}{self.count}'
+
+    def emit(self, line):
+        self.lines.append('    ' * self.depth + line)
+
+    def constant(self, value):
+        name = self.new('c')
+        self.constants[name] = value
+        return name
+
+    def point(self, joint_id):
+        key = ('point', joint_id)
+        if key not in self.known:
+            (x, y) = (self.new('x'), self.new('y'))
+            self.emit(f'{x}, {y} = skeleton[{joint_id!r}]')
+            self.known[key] = (x, y)
+        return self.known[key]
+
+    def body_scale(self):
+        # Inlined counterpart of body_scale, computed once per block.
+        key = ('scale',)
+        if key not in self.known:
+            (nx, ny) = self.point('neck')
+            (rx, ry) = self.point('rhip')
+            (lx, ly) = self.point('lhip')
+            (dx, dy) = (self.new('dx'), self.new('dy'))
+            self.emit(f'{dx}, {dy} = ({rx} + {lx}) / 2 - {nx}, ({ry} + {ly}) / 2 - {ny}')
+            scale = self.new('s')
+            self.emit(f'{scale} = max({self.constant(math.sqrt)}({dx} * {dx} + {dy} * {dy}), {EPSILON!r})')
+            self.known[key] = scale
+        return self.known[key]
+
+    def value(self, pose):
+        if pose not in self.known:
+            self.known[pose] = pose.emit(self)
+        return self.known[pose]
+
+    @contextlib.contextmanager
+    def block(self, header):
+        # Values computed inside a branch are not available after it.
+        self.emit(header)
+        known = dict(self.known)
+        self.depth += 1
+        yield
+        self.depth -= 1
+        self.known = known
+
+    def function(self, pose):
+        result = self.value(pose)
+        source = 'def score(skeleton):\n' + '\n'.join(self.lines) + f'\n    return {result}\n'
+        namespace = dict(self.constants)
+        exec(source, namespace)
+        score = namespace['score']
+        score.source = source
+        return score
+
+def emit_relation(gen, first, second, axis, precedes):
+    # Inlined counterpart of batch_precedes/batch_follows for one skeleton.
+    a = [point[axis] for point in first.emit_points(gen)]
+    b = [point[axis] for point in second.emit_points(gen)]
+    a_joint = isinstance(first, JointSelector)
+    b_joint = isinstance(second, JointSelector)
+    result = gen.new('v')
+    if a_joint and b_joint:
+        gen.emit(f'{result} = 1 if {a[0]} {"<" if precedes else ">"} {b[0]} else 0')
+        return result
+    (lo_a, hi_a) = emit_extent(gen, a)
+    (lo_b, hi_b) = emit_extent(gen, b)
+    if a_joint:
+        (numerator, lo, hi) = (f'{hi_b} - {lo_a}' if precedes else f'{hi_a} - {lo_b}', lo_b, hi_b)
+    else:
+        (numerator, lo, hi) = (f'{lo_b} - {lo_a}' if precedes else f'{hi_a} - {hi_b}', lo_a, hi_a)
+    gen.emit(f'{result} = max(0, min(1, ({numerator}) / ({hi} - {lo} + {EPSILON!r})))')
+    return result
+
+def emit_extent(gen, values):
+    if len(values) == 1:
+        return (values[0], values[0])
+    (lo, hi) = (gen.new('lo'), gen.new('hi'))
+    gen.emit(f'{lo}, {hi} = min({", ".join(values)}), max({", ".join(values)})')
+    return (lo, hi)
+
+# Inlined counterparts of the geometry kernels for one skeleton. a and b are the (x, y)
+# locals of each operand's points and scale the local of the body scale. The arithmetic is
+# the kernels', in the same order, so both give the same floats.
+
+def emit_fuzzy(gen, expression):
+    result = gen.new('v')
+    gen.emit(f'{result} = max(0, min(1, {expression}))')
+    return result
+
+def emit_reduce(function, values):
+    return values[0] if len(values) == 1 else f'{function}({", ".join(values)})'
+
+def emit_mean(values):
+    return values[0] if len(values) == 1 else f'({" + ".join(values)}) / {len(values)}'
+
+def emit_vector(gen, start, end):
+    (x, y) = (gen.new('ux'), gen.new('uy'))
+    gen.emit(f'{x}, {y} = {end[0]} - {start[0]}, {end[1]} - {start[1]}')
+    return (x, y)
+
+def emit_norm2(u):
+    # x * x rather than x ** 2, which is a libm pow that can differ from numpy's square.
+    return f'{u[0]} * {u[0]} + {u[1]} * {u[1]}'
+
+def emit_distance(gen, a, b, scale):
+    sqrt = gen.constant(math.sqrt)
+    distance = gen.new('d')
+    pairs = [f'{sqrt}({emit_norm2(emit_vector(gen, q, p))})' for p in a for q in b]
+    gen.emit(f'{distance} = {emit_reduce("min", pairs)} / {scale}')
+    return distance
+
+def emit_near(gen, a, b, scale):
+    return emit_fuzzy(gen, f'({FAR!r} - {emit_distance(gen, a, b, scale)}) / {FAR - NEAR!r}')
+
+def emit_far(gen, a, b, scale):
+    return emit_fuzzy(gen, f'({emit_distance(gen, a, b, scale)} - {NEAR!r}) / {FAR - NEAR!r}')
+
+def emit_level(gen, a, b, scale, axis):
+    offset = f'abs({emit_mean([point[axis] for point in a])} - {emit_mean([point[axis] for point in b])}) / {scale}'
+    return emit_fuzzy(gen, f'1 - {offset} / {LEVEL!r}')
+
+def emit_same_height(gen, a, b, scale):
+    return emit_level(gen, a, b, scale, 1)
+
+def emit_same_width(gen, a, b, scale):
+    return emit_level(gen, a, b, scale, 0)
+
+def emit_aligned(gen, a, b, scale):
+    if len(b) == 1:
+        (a, b) = (b, a)
+    offset = gen.new('o')
+    if len(b) == 1:
+        gen.emit(f'{offset} = min(abs({a[0][0]} - {b[0][0]}), abs({a[0][1]} - {b[0][1]}))')
+    else:
+        (x0, y0) = b[0]
+        (dx, dy) = emit_vector(gen, b[0], b[-1])
+        length = gen.new('l')
+        gen.emit(f'{length} = {gen.constant(math.sqrt)}({emit_norm2((dx, dy))}) + {EPSILON!r}')
+        crosses = [f'abs({dx} * ({y} - {y0}) - {dy} * ({x} - {x0}))' for (x, y) in a]
+        gen.emit(f'{offset} = {emit_reduce("max", crosses)} / {length}')
+    return emit_fuzzy(gen, f'1 - {offset} / {scale} / {LEVEL!r}')
+
+def emit_angle(gen, u, v, absolute=False):
+    # np.arccos rather than math.acos, which differs from it in the last bit.
+    cos = f'({u[0]} * {v[0]} + {u[1]} * {v[1]}) / ({gen.constant(math.sqrt)}(({emit_norm2(u)}) * ({emit_norm2(v)})) + {EPSILON!r})'
+    angle = gen.new('a')
+    gen.emit(f'{angle} = {gen.constant(np.arccos)}(max(-1, min(1, {f"abs({cos})" if absolute else cos})))')
+    return angle
+
+def emit_points_to(gen, a, b, scale):
+    (tx, ty) = (gen.new('tx'), gen.new('ty'))
+    gen.emit(f'{tx}, {ty} = {emit_mean([x for (x, y) in b])}, {emit_mean([y for (x, y) in b])}')
+    ((fx, fy), (lx, ly)) = (a[0], a[-1])
+    (first, last) = (emit_vector(gen, (tx, ty), a[0]), emit_vector(gen, (tx, ty), a[-1]))
+    tip = (gen.new('px'), gen.new('py'))
+    base = (gen.new('qx'), gen.new('qy'))
+    gen.emit(f'{", ".join(tip + base)} = ({fx}, {fy}, {lx}, {ly}) if {emit_norm2(first)} < {emit_norm2(last)} '
+             f'else ({lx}, {ly}, {fx}, {fy})')
+    angle = emit_angle(gen, emit_vector(gen, base, tip), emit_vector(gen, tip, (tx, ty)))
+    return emit_fuzzy(gen, f'1 - {angle} / {POINTING!r}')
+
+def emit_parallel(gen, a, b, scale):
+    # None when an operand has no bone, which the kernel rejects.
+    bones_a = [emit_vector(gen, start, end) for (start, end) in zip(a, a[1:])]
+    bones_b = [emit_vector(gen, start, end) for (start, end) in zip(b, b[1:])]
+    if not bones_a or not bones_b:
+        return None
+    angles = [emit_angle(gen, u, v, True) for u in bones_a for v in bones_b]
+    return emit_fuzzy(gen, f'1 - {emit_reduce("max", angles)} / {PARALLEL!r}')
+
+def emit_crosses(gen, a, b, scale):
+    def cross(u, v):
+        return f'({u[0]} * {v[1]} - {u[1]} * {v[0]})'
+    bones_a = [(a1, a2, emit_vector(gen, a1, a2)) for (a1, a2) in zip(a, a[1:])]
+    bones_b = [(b1, b2, emit_vector(gen, b1, b2)) for (b1, b2) in zip(b, b[1:])]
+    tests = []
+    for (a1, a2, bone_a) in bones_a:
+        for (b1, b2, bone_b) in bones_b:
+            (a1_b1, a2_b1) = (emit_vector(gen, b1, a1), emit_vector(gen, b1, a2))
+            (b1_a1, b2_a1) = (emit_vector(gen, a1, b1), emit_vector(gen, a1, b2))
+            tests.append(f'{cross(bone_b, a1_b1)} * {cross(bone_b, a2_b1)} < 0 and {cross(bone_a, b1_a1)} * {cross(bone_a, b2_a1)} < 0')
+    result = gen.new('v')
+    gen.emit(f'{result} = 1.0 if {" or ".join(f"({test})" for test in tests)} else 0.0' if tests else f'{result} = 0.0')
+    return result
+
+def compile_scalar(pose):
+    # Generated single-skeleton scoring function of the pose, built once per pose. It is
+    # kept on the pose: the function may hold the pose or some of its nodes, and that
+    # cycle is left to the garbage collector once neither is used anymore.
+    score = getattr(pose, 'scalar', None)
+    if score is None:
+        score = pose.scalar = ScalarCodegen().function(pose)
+    return score
+
+def intern_node(cls, key):
+    node = INTERNED.get(key)
+    if node is None:
+        node = object.__new__(cls)
+        node.key = key
+        node.hash = hash(key)
+        INTERNED[key] = node
+    return node
+
 
 class Pose:
 
+    scales = 0
+
+    def __new__(cls, *operands):
+        return intern_node(cls, (cls,) + operands)
+
     def __init__(self, first, second):
         self.first = first
         self.second = second
+        # Geometry leaves of the pose, which all need the body scale of the skeleton.
+        self.scales = getattr(first, 'scales', 0) + getattr(second, 'scales', 0)
        
     def __call__(self, skeleton):
+        if isinstance(skeleton, EvaluationContext):
+            return skeleton.score(self)
+        if self.scales > 1:
+            # The body scale is then computed once, for all of them.
+            return EvaluationContext(skeleton).score(self)
+        return self.evaluate(skeleton)
+
+    def evaluate(self, skeleton):
         pass
 
     def matches(self, skeleton, tolerance=.8):
         return self(skeleton) > tolerance
 
+    def score_above(self, skeleton, floor):
+        # The exact score when it is above floor, otherwise any value not above floor. This
+        # lets combinators stop evaluating once a pose cannot beat floor anymore.
+        return self(skeleton)
+
     def __and__(self, other): # this redefines the '&' operator, not 'and'
+        # p & p = p, p & (p | q) = p
+        if self is other or absorbs(self, other, OrPose):
+            return self
+        if absorbs(other, self, OrPose):
+            return other
         return AndPose(self, other)
 
     def __or__(self, other): # this redefines the '|' operator, not 'or'
+        # p | p = p, p | (p & q) = p
+        if self is other or absorbs(self, other, AndPose):
+            return self
+        if absorbs(other, self, AndPose):
+            return other
         return OrPose(self, other)
 
     def __invert__(self): # this redefines the unary '~' operator, not 'not'
         return NotPose(self)
 
+    def __eq__(self, other):
+        if not isinstance(other, Pose):
+            return NotImplemented
+        return self is other or self.key == other.key
+
+    def __hash__(self):
+        return self.hash
+
+    def __reduce__(self):
+        return (self.key[0], self.key[1:])
+
+    def joints(self):
+        # Ids of the joints the pose reads, None when they are not known.
+        first = self.first.joints()
+        second = self.second.joints()
+        return None if first is None or second is None else first | second
+
+    def compile(self, joints=MPI_JOINTS):
+        return compile_pose(self, joints)
+
+    def lower(self, index):
+        return lower_rows(self, index)
+
+    def compile_scalar(self):
+        return compile_scalar(self)
+
+    def emit(self, gen):
+        # Poses without generated code are called through their own evaluate.
+        result = gen.new('v')
+        gen.emit(f'{result} = {gen.constant(self)}.evaluate(skeleton)')
+        return result
+
     def __repr__(self):
-        return f'{self.__class__.__name__}({self.first.__repr__()}, {self.second.__repr__()})'
+        return f'{self.__class__.__name__}({", ".join(operand.__repr__() for operand in self.key[1:])})'
+
+
+def absorbs(pose, other, combinator):
+    # Whether other is `pose combinator q` or `q combinator pose`.
+    return type(other) is combinator and (other.first is pose or other.second is pose)
+
+def simplify(pose):
+    # Rebuilds a pose through its operators, which apply the identities of min/max/1-x
+    # fuzzy logic. ~~p becomes p, which may differ from 1 - (1 - p) in the last bit.
+    if isinstance(pose, AndPose):
+        return simplify(pose.first) & simplify(pose.second)
+    elif isinstance(pose, OrPose):
+        return simplify(pose.first) | simplify(pose.second)
+    elif isinstance(pose, NotPose):
+        return ~simplify(pose.pose)
+    return pose
 
 
 class AndPose(Pose):
 
-    def __call__(self, skeleton):
-        return min(self.first(skeleton), self.second(skeleton))
+    # Scores are in [0, 1], so a first operand at 0 already decides the result.
+    def evaluate(self, skeleton):
+        first = self.first(skeleton)
+        if first <= 0:
+            return first
+        return min(first, self.second(skeleton))
+
+    def matches(self, skeleton, tolerance=.8):
+        return self.first.matches(skeleton, tolerance) and self.second.matches(skeleton, tolerance)
+
+    def score_above(self, skeleton, floor):
+        first = self.first.score_above(skeleton, floor)
+        if first <= floor or first <= 0:
+            return first
+        return min(first, self.second.score_above(skeleton, floor))
+
+    def lower(self, index):
+        first, second = self.first.lower(index), self.second.lower(index)
+        return lambda coords, scale: batch_and(first(coords, scale), second(coords, scale))
+
+    def emit(self, gen):
+        first = gen.value(self.first)
+        result = gen.new('v')
+        with gen.block(f'if {first} <= 0:'):
+            gen.emit(f'{result} = {first}')
+        with gen.block('else:'):
+            gen.emit(f'{result} = min({first}, {gen.value(self.second)})')
+        return result
     
 
 class OrPose(Pose):
 
-    def __call__(self, skeleton):
-        return max(self.first(skeleton), self.second(skeleton))
+    # Likewise, a first operand at 1 already decides the result.
+    def evaluate(self, skeleton):
+        first = self.first(skeleton)
+        if first >= 1:
+            return first
+        return max(first, self.second(skeleton))
+
+    def matches(self, skeleton, tolerance=.8):
+        return self.first.matches(skeleton, tolerance) or self.second.matches(skeleton, tolerance)
+
+    def score_above(self, skeleton, floor):
+        # The second operand only matters if it beats both floor and the first operand.
+        first = self.first.score_above(skeleton, floor)
+        if first >= 1:
+            return first
+        return max(first, self.second.score_above(skeleton, max(floor, first)))
+
+    def lower(self, index):
+        first, second = self.first.lower(index), self.second.lower(index)
+        return lambda coords, scale: batch_or(first(coords, scale), second(coords, scale))
+
+    def emit(self, gen):
+        first = gen.value(self.first)
+        result = gen.new('v')
+        with gen.block(f'if {first} >= 1:'):
+            gen.emit(f'{result} = {first}')
+        with gen.block('else:'):
+            gen.emit(f'{result} = max({first}, {gen.value(self.second)})')
+        return result
 
 
 class NotPose(Pose):
 
+    def __new__(cls, pose):
+        # ~~p = p
+        if type(pose) is NotPose:
+            return pose.pose
+        return super().__new__(cls, pose)
+
     def __init__(self, pose):
         self.pose = pose
+        self.scales = pose.scales
 
-    def __call__(self, skeleton):
+    def evaluate(self, skeleton):
         return 1 - self.pose(skeleton)
 
+    def joints(self):
+        return self.pose.joints()
+
+    def lower(self, index):
+        pose = self.pose.lower(index)
+        return lambda coords, scale: 1 - pose(coords, scale)
+
+    def emit(self, gen):
+        pose = gen.value(self.pose)
+        result = gen.new('v')
+        gen.emit(f'{result} = 1 - {pose}')
+        return result
+
 class LambdaPose(Pose):
     
     def __init__(self, criterion):
         self.criterion = criterion
 
-    def __call__(self, skeleton):
+    def evaluate(self, skeleton):
         return self.criterion(skeleton)
-    
+
+    def joints(self):
+        return None
+
 class Above(Pose):
 
-    def __call__(self, skeleton):
+    def evaluate(self, skeleton):
         return self.first(skeleton).above(self.second(skeleton))
 
+    def lower(self, index):
+        return lower_relation(self.first, self.second, index, batch_precedes, 1)
+
+    def emit(self, gen):
+        return emit_relation(gen, self.first, self.second, 1, True)
+
 class Below(Pose):
     
-    def __call__(self, skeleton):
+    def evaluate(self, skeleton):
         return self.first(skeleton).below(self.second(skeleton))
 
+    def lower(self, index):
+        return lower_relation(self.first, self.second, index, batch_follows, 1)
+
+    def emit(self, gen):
+        return emit_relation(gen, self.first, self.second, 1, False)
+
 class ToTheRight(Pose):
 
-    def __call__(self, skeleton):
+    def evaluate(self, skeleton):
         return self.first(skeleton).to_the_right(self.second(skeleton))
 
+    def lower(self, index):
+        return lower_relation(self.first, self.second, index, batch_follows, 0)
+
+    def emit(self, gen):
+        return emit_relation(gen, self.first, self.second, 0, False)
+
 class ToTheLeft(Pose):
 
-    def __call__(self, skeleton):
+    def evaluate(self, skeleton):
         return self.first(skeleton).to_the_left(self.second(skeleton))
-               
-class AtSameHeight(Pose):
 
-    def __call__(self, skeleton):
-        return self.first(skeleton).at_same_height(self.second(skeleton))
+    def lower(self, index):
+        return lower_relation(self.first, self.second, index, batch_precedes, 0)
 
-class AtSameWidth(Pose):
+    def emit(self, gen):
+        return emit_relation(gen, self.first, self.second, 0, True)
 
-    def __call__(self, skeleton):
-        return self.first(skeleton).at_same_width(self.seccond(skeleton))
+class GeometryRelation(Pose):
 
-class IsNear(Pose): 
+    # Scored by the METHOD of the selected parts, by KERNEL over arrays, or by the code EMIT
+    # writes, all taking the body scale of the skeleton. Geometry relations also read the
+    # joints of the body scale.
+    def __init__(self, first, second):
+        super().__init__(first, second)
+        self.scales = 1
 
-    def __call__(self, skeleton):
-        return self.first(skeleton).is_near(self.second(skeleton))
+    def evaluate(self, skeleton):
+        return getattr(self.first(skeleton), self.METHOD)(self.second(skeleton), body_scale(skeleton))
 
-class IsFar(Pose): 
+    def joints(self):
+        joints = super().joints()
+        return None if joints is None else joints | SCALE_JOINTS
 
-    def __call__(self, skeleton):
-        return self.first(skeleton).is_far(self.second(skeleton))
+    def lower(self, index):
+        return lower_geometry(self.first, self.second, index, self.KERNEL)
 
-class PointsTo(Pose):
+    def emit(self, gen):
+        # Parts without METHOD, like joints for points_to, are left to evaluate, which
+        # raises, and so are the operands EMIT gives up on.
+        if isinstance(self.first, JointSelector) and not hasattr(Joint, self.METHOD):
+            return super().emit(gen)
+        (a, b) = (self.first.emit_points(gen), self.second.emit_points(gen))
+        result = self.EMIT(gen, a, b, gen.body_scale())
+        return super().emit(gen) if result is None else result
 
-    def __call__(self, skeleton):
-        return self.first(skeleton).points_to(self.second(skeleton))
-        
-class AlignedWith(Pose):
+class AtSameHeight(GeometryRelation):
 
-    def __call__(self, skeleton):
-        return self.first(skeleton).aligned_with(self.second(skeleton))
+    METHOD = 'at_same_height'
+    KERNEL = staticmethod(batch_same_height)
+    EMIT = staticmethod(emit_same_height)
 
-class Crosses(Pose):
+class AtSameWidth(GeometryRelation):
 
-    def __call__(self, skeleton):
-        return self.first(skeleton).crosses(self.second(skeleton))
+    METHOD = 'at_same_width'
+    KERNEL = staticmethod(batch_same_width)
+    EMIT = staticmethod(emit_same_width)
+
+class IsNear(GeometryRelation):
+
+    METHOD = 'is_near'
+    KERNEL = staticmethod(batch_near)
+    EMIT = staticmethod(emit_near)
 
-class Parallel(Pose):
+class IsFar(GeometryRelation):
+
+    METHOD = 'is_far'
+    KERNEL = staticmethod(batch_far)
+    EMIT = staticmethod(emit_far)
+
+class PointsTo(GeometryRelation):
+
+    METHOD = 'points_to'
+    KERNEL = staticmethod(batch_points_to)
+    EMIT = staticmethod(emit_points_to)
+
+class AlignedWith(GeometryRelation):
+
+    METHOD = 'aligned_with'
+    KERNEL = staticmethod(batch_aligned)
+    EMIT = staticmethod(emit_aligned)
+
+class Crosses(GeometryRelation):
+
+    METHOD = 'crosses'
+    KERNEL = staticmethod(batch_crosses)
+    EMIT = staticmethod(emit_crosses)
+
+class Parallel(GeometryRelation):
+
+    METHOD = 'parallel'
+    KERNEL = staticmethod(batch_parallel)
+    EMIT = staticmethod(emit_parallel)
+
+
+class Selector:
+
+    def __new__(cls, selector_id):
+        return intern_node(cls, (cls, tuple(selector_id) if isinstance(selector_id, list) else selector_id))
+
+    def __eq__(self, other):
+        if not isinstance(other, Selector):
+            return NotImplemented
+        return self is other or self.key == other.key
+
+    def __hash__(self):
+        return self.hash
+
+    def __reduce__(self):
+        return (self.key[0], (self.key[1],))
 
     def __call__(self, skeleton):
-       return self.first(skeleton).parallel(self.second(skeleton))
-   
+        if isinstance(skeleton, EvaluationContext):
+            return skeleton.resolve(self)
+        return self.select(skeleton)
+
 
-class JointSelector:
+class JointSelector(Selector):
 
     def __init__(self, joint_id):
         self.joint_id = joint_id
     
-    def __call__(self, skeleton):
+    def select(self, skeleton):
         (x, y) = skeleton[self.joint_id]
         return Joint(self.joint_id, x, y)
 
+    def columns(self, index):
+        return [index[self.joint_id]]
+
+    def joints(self):
+        return frozenset((self.joint_id,))
+
+    def emit_points(self, gen):
+        return [gen.point(self.joint_id)]
+
     def above(self, other):
         return Above(self, other)
         
@@ -167,6 +922,9 @@ class JointSelector:
     def is_far(self, other):
         return IsFar(self, other)
 
+    def aligned_with(self, other):
+        return AlignedWith(self, other)
+
     def __repr__(self):
         return f'JointSelector({self.joint_id.__repr__()})'
    
@@ -190,6 +948,8 @@ class Joint:
     right_ankle = 'rankle'
     left_ankle = 'lankle'
 
+    __slots__ = ('id', 'x', 'y')
+
     def __init__(self, id: str, x: int, y: int):
         self.id = id
         self.x = x
@@ -198,6 +958,9 @@ class Joint:
     def __repr__(self):
         return f'Joint({self.id.__repr__()}, {self.x.__repr__()}, {self.y.__repr__()})'
 
+    def to_joint_list(self):
+        return [self]
+
 
     def above(self, other):
         #TODO: Simple implementation for the moment, see results in practice
@@ -241,34 +1004,41 @@ class Joint:
         coord = [joint.x for joint in others]
         return relative_diff(coord, self.x, False)
 
-    #TODO: add more methods for pose description
-       
-    def is_near(self, other):
-        pass
+    def is_near(self, other, scale):
+        return part_relation(batch_near, self, other, scale)
 
-    def is_far(self, other):
-        pass
+    def is_far(self, other, scale):
+        return part_relation(batch_far, self, other, scale)
 
-    def at_same_height(self, other):
-        pass
+    def at_same_height(self, other, scale):
+        return part_relation(batch_same_height, self, other, scale)
 
-    def at_same_width(self, other):
-        pass
+    def at_same_width(self, other, scale):
+        return part_relation(batch_same_width, self, other, scale)
 
-    def aligned_with(self, other):
-        pass
+    def aligned_with(self, other, scale):
+        return part_relation(batch_aligned, self, other, scale)
 
 
-class SegmentSelector:
+class SegmentSelector(Selector):
 
     def __init__(self, segm_id: tuple):
         self.segm_id = segm_id
+        self.joint_selectors = [JointSelector(joint) for joint in segm_id]
 
-    def __call__(self, skeleton):
-        j1 = JointSelector(self.segm_id[0])
-        j2 = JointSelector(self.segm_id[1])
+    def select(self, skeleton):
+        (j1, j2) = self.joint_selectors
         return Segment(j1(skeleton), j2(skeleton))
 
+    def columns(self, index):
+        return [index[joint] for joint in self.segm_id]
+
+    def joints(self):
+        return frozenset(self.segm_id)
+
+    def emit_points(self, gen):
+        return [gen.point(joint) for joint in self.segm_id]
+
     def above(self, other):
         return Above(self, other)
 
@@ -302,6 +1072,9 @@ class SegmentSelector:
     def parallel(self, other):
         return Parallel(self, other)
 
+    def crosses(self, other):
+        return Crosses(self, other)
+
     def __repr__(self):
         return f'SegmentSelector({self.segm_id.__repr__()})'
 
@@ -323,6 +1096,8 @@ class Segment:
     left_calf = ('lknee', 'lankle')
 
     
+    __slots__ = ('firstJoint', 'secondJoint')
+
     def __init__(self, firstJoint, secondJoint):
         self.firstJoint = firstJoint
         self.secondJoint = secondJoint
@@ -379,41 +1154,49 @@ class Segment:
         left2 = min(joint.x for joint in others)
         return relative_diff(self.right_left(), left2, True)
 
-    #TODO: add more methods for pose description
+    def is_near(self, other, scale):
+        return part_relation(batch_near, self, other, scale)
 
-    def is_near(self, other):
-        pass
-    
-    def is_far(self, other):
-        pass
-   
-    def at_same_height(self, other):
-        pass
+    def is_far(self, other, scale):
+        return part_relation(batch_far, self, other, scale)
 
-    def at_same_width(self, other):
-        pass
+    def at_same_height(self, other, scale):
+        return part_relation(batch_same_height, self, other, scale)
 
-    def points_to(self, other):
-        pass
+    def at_same_width(self, other, scale):
+        return part_relation(batch_same_width, self, other, scale)
 
-    def crosses(self, other):
-        pass
+    def points_to(self, other, scale=None):
+        return part_relation(batch_points_to, self, other, scale)
 
-    def parallel(self, other):
-        pass
+    def crosses(self, other, scale=None):
+        return part_relation(batch_crosses, self, other, scale)
 
-    def aligned_with(self, other):
-        pass
+    def parallel(self, other, scale=None):
+        return part_relation(batch_parallel, self, other, scale)
+
+    def aligned_with(self, other, scale):
+        return part_relation(batch_aligned, self, other, scale)
 
-class LimbSelector:
+class LimbSelector(Selector):
 
     def __init__(self, limb_id: List[str]):
         self.limb_id = limb_id
+        self.joint_selectors = [JointSelector(joint) for joint in limb_id]
 
-    def __call__(self, skeleton):
-        joint_list = [JointSelector(joint)(skeleton) for joint in self.limb_id]
+    def select(self, skeleton):
+        joint_list = [joint(skeleton) for joint in self.joint_selectors]
         return Limb(joint_list)
 
+    def columns(self, index):
+        return [index[joint] for joint in self.limb_id]
+
+    def joints(self):
+        return frozenset(self.limb_id)
+
+    def emit_points(self, gen):
+        return [gen.point(joint) for joint in self.limb_id]
+
     def above(self, other):
         return Above(self, other)
 
@@ -447,6 +1230,9 @@ class LimbSelector:
     def parallel(self, other):
         return Parallel(self, other)
 
+    def crosses(self, other):
+        return Crosses(self, other)
+
     def straight(self):
         return Parallel(self, self)
 
@@ -462,6 +1248,8 @@ class Limb:
     left_leg = ['lhip', 'lknee', 'lankle']
 
 
+    __slots__ = ('joints',)
+
     def __init__(self, joints):
         self.joints = joints
 
@@ -533,6 +1321,31 @@ class Limb:
         left2 = min(joint.x for joint in others)
         return relative_diff(coord, left2, True)
 
+    def is_near(self, other, scale):
+        return part_relation(batch_near, self, other, scale)
+
+    def is_far(self, other, scale):
+        return part_relation(batch_far, self, other, scale)
+
+    def at_same_height(self, other, scale):
+        return part_relation(batch_same_height, self, other, scale)
+
+    def at_same_width(self, other, scale):
+        return part_relation(batch_same_width, self, other, scale)
+
+    def points_to(self, other, scale=None):
+        return part_relation(batch_points_to, self, other, scale)
+
+    def crosses(self, other, scale=None):
+        return part_relation(batch_crosses, self, other, scale)
+
+    def parallel(self, other, scale=None):
+        # Every bone of both parts, so a limb parallel to itself is a straight limb.
+        return part_relation(batch_parallel, self, other, scale)
+
+    def aligned_with(self, other, scale):
+        return part_relation(batch_aligned, self, other, scale)
+
 class Body:
 
     right_wrist = JointSelector(Joint.right_wrist)
@@ -570,3 +1383,238 @@ class Body:
     left_arm = LimbSelector(Limb.left_arm)
     right_leg = LimbSelector(Limb.right_leg)
     left_leg = LimbSelector(Limb.left_leg)
+
+
+def body_selectors():
+    # Every distinct joint, segment and limb selector defined on Body, in definition order.
+    selectors = {}
+    for value in vars(Body).values():
+        if isinstance(value, Selector):
+            selectors.setdefault(value, None)
+    return list(selectors)
+
+
+class RelationLayout:
+
+    # The relation leaves a RelationTable computes and the columns of the entities they
+    # compare, worked out once for any number of tables. poses defaults to every relation
+    # between the joints, segments and limbs of Body; poses that are not relations, or
+    # that read joints missing from joints, are left out.
+    def __init__(self, poses=None, joints=MPI_JOINTS):
+        if poses is None:
+            selectors = body_selectors()
+            poses = [relation(first, second) for relation in RelationTable.RELATIONS
+                     for first in selectors for second in selectors]
+        index = {joint: i for i, joint in enumerate(joints)}
+        self.index = {}
+        entities = {}
+        columns = []
+        pairs = []
+        for pose in poses:
+            if type(pose) not in RelationTable.RELATIONS or pose in self.index:
+                continue
+            try:
+                operands = [(entity, entity.columns(index)) for entity in (pose.first, pose.second)]
+            except KeyError:
+                continue
+            for (entity, cols) in operands:
+                if entity not in entities:
+                    entities[entity] = len(columns)
+                    columns.append(cols)
+            (axis, precedes) = RelationTable.RELATIONS[type(pose)]
+            self.index[pose] = len(pairs)
+            pairs.append((entities[pose.first], entities[pose.second], axis, precedes,
+                          isinstance(pose.first, JointSelector), isinstance(pose.second, JointSelector)))
+        self.entities = list(entities)
+
+        # Entities of fewer joints are padded with their first joint, which leaves their
+        # extents unchanged.
+        width = max((len(cols) for cols in columns), default=1)
+        self.columns = np.array([cols + cols[:1] * (width - len(cols)) for cols in columns], dtype=int).reshape(-1, width)
+        (self.first, self.second, self.axis) = (np.array([pair[k] for pair in pairs], dtype=int) for k in range(3))
+        (self.precedes, self.a_joint, self.b_joint) = (np.array([pair[k] for pair in pairs], dtype=bool) for k in range(3, 6))
+
+    def __len__(self):
+        return len(self.index)
+
+    def __repr__(self):
+        return f'RelationLayout({len(self)} relations, {len(self.entities)} entities)'
+
+
+@functools.lru_cache(maxsize=None)
+def body_relation_layout(joints=tuple(MPI_JOINTS)):
+    # The default RelationLayout, made once per joint format.
+    return RelationLayout(None, list(joints))
+
+
+class RelationTable:
+
+    # Relation leaves (above, below, to_the_right and to_the_left) scored in one vectorized
+    # pass, only those of layout: a RelationLayout, the poses to make one of, or None for
+    # every relation between the entities of Body. coords is one skeleton as a (J, 2)
+    # array or a batch as (N, J, 2); values has shape (..., L) and lookup() gives what the
+    # relation leaf would score, a float for one skeleton or an (N,) array for a batch.
+    RELATIONS = {Above: (1, True), Below: (1, False), ToTheRight: (0, False), ToTheLeft: (0, True)}
+
+    def __init__(self, coords, layout=None, joints=MPI_JOINTS):
+        if layout is None:
+            layout = body_relation_layout(tuple(joints))
+        self.layout = layout if isinstance(layout, RelationLayout) else RelationLayout(layout, joints)
+        self.single = np.ndim(coords) == 2
+        layout = self.layout
+        points = np.asarray(coords, dtype=float)[..., layout.columns, :]
+        lo = points.min(axis=-2)
+        hi = points.max(axis=-2)
+        (first, second, axis) = (layout.first, layout.second, layout.axis)
+        self.values = relation_pairs(lo[..., first, axis], hi[..., first, axis], layout.a_joint,
+                                     lo[..., second, axis], hi[..., second, axis], layout.b_joint, layout.precedes)
+
+    @classmethod
+    def from_skeleton(cls, skeleton, layout=None, joints=MPI_JOINTS):
+        return cls(skeletons_to_array([skeleton], joints)[0], layout, joints)
+
+    def __contains__(self, pose):
+        return pose in self.layout.index
+
+    def lookup(self, pose):
+        # None when the pose is not a relation of the table.
+        i = self.layout.index.get(pose)
+        if i is None:
+            return None
+        value = self.values[..., i]
+        return float(value) if self.single else value
+
+    def __repr__(self):
+        return f'RelationTable({len(self.layout)} relations, shape={self.values.shape})'
+
+
+class EvaluationContext:
+
+    # Scores poses against one skeleton, remembering every resolved selector and every
+    # pose result, so that selectors and subtrees shared between poses, or poses scored
+    # several times, are only evaluated once. reset() moves on to the next skeleton and
+    # forgets everything remembered for the previous one. With relations, relation leaves
+    # are looked up in a RelationTable built once for the skeleton: relations is then the
+    # RelationLayout of the table, or True for the default one.
+    def __init__(self, skeleton=None, relations=False):
+        self.skeleton = skeleton
+        self.relations = relations
+        self.selections = {}
+        self.results = {}
+        self.table = None
+        self.scale = None
+
+    def reset(self, skeleton):
+        self.skeleton = skeleton
+        self.selections.clear()
+        self.results.clear()
+        self.table = None
+        self.scale = None
+
+    def body_scale(self):
+        if self.scale is None:
+            self.scale = body_scale(self.skeleton)
+        return self.scale
+
+    def relation_table(self):
+        if self.table is None:
+            self.table = RelationTable.from_skeleton(self.skeleton, None if self.relations is True else self.relations)
+        return self.table
+
+    def __call__(self, pose):
+        return self.score(pose)
+
+    def score(self, pose):
+        try:
+            return self.results[pose]
+        except KeyError:
+            result = self.relation_table().lookup(pose) if self.relations else None
+            # Relations on missing joints are NaN in the table, evaluate() reports them.
+            if result is None or result != result:
+                result = pose.evaluate(self)
+            self.results[pose] = result
+            return result
+
+    def resolve(self, selector):
+        try:
+            return self.selections[selector]
+        except KeyError:
+            selection = self.selections[selector] = selector.select(self)
+            return selection
+
+    def __getitem__(self, joint_id):
+        return self.skeleton[joint_id]
+
+    def get(self, joint_id, default=None):
+        return self.skeleton.get(joint_id, default)
+
+    def __contains__(self, joint_id):
+        return joint_id in self.skeleton
+
+    def __iter__(self):
+        return iter(self.skeleton)
+
+    def __len__(self):
+        return len(self.skeleton)
+
+    def keys(self):
+        return self.skeleton.keys()
+
+    def values(self):
+        return self.skeleton.values()
+
+    def items(self):
+        return self.skeleton.items()
+
+
+class Skeleton:
+
+    # Compact skeleton: the joints of a format stored in a (J, 2) float array, with NaN for
+    # joints that were not found. It reads like the skeleton dicts built by pose_estimation,
+    # so it can be passed anywhere such a dict is expected.
+    __slots__ = ('format', 'coords')
+
+    def __init__(self, coords, format=FORMATS['MPI']):
+        self.format = FORMATS[format] if isinstance(format, str) else format
+        self.coords = np.asarray(coords, dtype=float).reshape(len(self.format.joints), 2)
+
+    @classmethod
+    def from_dict(cls, skeleton, format=FORMATS['MPI']):
+        # Joints missing from the format, such as 'background', are dropped.
+        format = FORMATS[format] if isinstance(format, str) else format
+        return cls(skeletons_to_array([skeleton], format.joints)[0], format)
+
+    def to_dict(self):
+        return dict(self.items())
+
+    def point(self, i: int):
+        (x, y) = self.coords[i].tolist()
+        return None if x != x or y != y else (x, y)
+
+    def __getitem__(self, joint_id):
+        return self.point(self.format.index[joint_id])
+
+    def get(self, joint_id, default=None):
+        i = self.format.index.get(joint_id)
+        return default if i is None else self.point(i)
+
+    def __contains__(self, joint_id):
+        return joint_id in self.format.index
+
+    def __iter__(self):
+        return iter(self.format.joints)
+
+    def __len__(self):
+        return len(self.format.joints)
+
+    def keys(self):
+        return list(self.format.joints)
+
+    def values(self):
+        return [self.point(i) for i in range(len(self))]
+
+    def items(self):
+        return list(zip(self.format.joints, self.values()))
+
+    def __repr__(self):
+        return f'Skeleton({self.to_dict().__repr__()}, {self.format.name.__repr__()})'
@@ -7,8 +7,11 @@
 import cv2 as cv
 import numpy as np
 import argparse
+import functools
+import itertools
 #import imutils
 import time
+from pose_cache import InferenceCache
 #parser = argparse.ArgumentParser(
 #        description='This script is used to demonstrate OpenPose human pose estimation network '
 #                    'from https://github.com/CMU-Perceptual-Computing-Lab/openpose project using OpenCV. '
@@ -24,11 +27,9 @@ import time
 
 #args = parser.parse_args()
 
-def pose_estimation(inputim, retframe=False, proto='pose/mpi/pose_deploy_linevec_faster_4_stages.prototxt', model='pose/mpi/pose_iter_160000.caffemodel', dataset='MPI', thr=0.1, width=368, height=368):
-
-    args = {'inputim': inputim, 'proto': proto, 'model': model, 'dataset': dataset, 'thr': thr, 'width': width, 'height': height}
+def body_tables(dataset):
 
-    if args['dataset'] == 'COCO':
+    if dataset == 'COCO':
         BODY_PARTS = { "Nose": 0, "Neck": 1, "RShoulder": 2, "RElbow": 3, "RWrist": 4,
                        "LShoulder": 5, "LElbow": 6, "LWrist": 7, "RHip": 8, "RKnee": 9,
                        "RAnkle": 10, "LHip": 11, "LKnee": 12, "LAnkle": 13, "REye": 14,
@@ -39,7 +40,7 @@ def pose_estimation(inputim, retframe=False, proto='pose/mpi/pose_deploy_linevec
                        ["Neck", "RHip"], ["RHip", "RKnee"], ["RKnee", "RAnkle"], ["Neck", "LHip"],
                        ["LHip", "LKnee"], ["LKnee", "LAnkle"], ["Neck", "Nose"], ["Nose", "REye"],
                        ["REye", "REar"], ["Nose", "LEye"], ["LEye", "LEar"] ]
-    elif args['dataset']=='MPI':
+    elif dataset=='MPI':
         #assert(args.dataset == 'MPI')
         BODY_PARTS = { "Head": 0, "Neck": 1, "RShoulder": 2, "RElbow": 3, "RWrist": 4,
                        "LShoulder": 5, "LElbow": 6, "LWrist": 7, "RHip": 8, "RKnee": 9,
@@ -57,62 +58,358 @@ def pose_estimation(inputim, retframe=False, proto='pose/mpi/pose_deploy_linevec
         POSE_PAIRS =[ ["Neck","MidHip"],   ["Neck","RShoulder"],   ["Neck","LShoulder"],   ["RShoulder","RElbow"],   ["RElbow","RWrist"],   ["LShoulder","LElbow"],   ["LElbow","LWrist"],   ["MidHip","RHip"],   ["RHip","RKnee"],  ["RKnee","RAnkle"], ["MidHip","LHip"],  ["LHip","LKnee"], ["LKnee","LAnkle"],  ["Neck","Nose"],   ["Nose","REye"], ["REye","REar"],  ["Nose","LEye"], ["LEye","LEar"],   
 ["RShoulder","REar"],  ["LShoulder","LEar"],   ["LAnkle","LBigToe"],["LBigToe","LSmallToe"],["LAnkle","LHeel"], ["RAnkle","RBigToe"],["RBigToe","RSmallToe"],["RAnkle","RHeel"] ]
 
-    inWidth = args['width']
-    inHeight = args['height']
+    return (BODY_PARTS, POSE_PAIRS)
 
-    net = cv.dnn.readNetFromCaffe(args['proto'], args['model'])
 
+def paf_tables(dataset):
+    # For every entry of POSE_PAIRS, the network channels holding the x and y components of
+    # its part affinity field, following the OpenPose output layout where the fields come
+    # right after the part heatmaps.
+    if dataset == 'COCO':
+        return [ (31, 32), (39, 40), (33, 34), (35, 36), (41, 42), (43, 44), (19, 20), (21, 22),
+                 (23, 24), (25, 26), (27, 28), (29, 30), (47, 48), (49, 50), (53, 54), (51, 52),
+                 (55, 56) ]
+    elif dataset == 'MPI':
+        return [ (16 + 2 * k, 17 + 2 * k) for k in range(14) ]
+    else:
+        return None
+
+
+def joint_names(BODY_PARTS):
+    # Skeleton dict keys for each part, e.g. "RShoulder" -> 'rshoulder'.
+    return [name.lower() for (name, i) in sorted(BODY_PARTS.items(), key=lambda item: item[1])]
+
+
+def decoded_channels(BODY_PARTS, joints=None):
+    # Heatmap channels of the given joint ids, None for every channel.
+    if joints is None:
+        return None
+    names = joint_names(BODY_PARTS)
+    unknown = set(joints) - set(names)
+    if unknown:
+        raise ValueError(f'Unknown joints {sorted(unknown)}')
+    return sorted(names.index(joint) for joint in joints)
+
+
+body_joints = { 0: "head", 1: "neck",2: "rshoulder", 3: "relbow", 4: "rwrist",
+                5: "lshoulder", 6: "lelbow", 7: "lwrist", 8: "rhip", 9: "rknee",
+                10: "rankle", 11: "lhip", 12: "lknee", 13: "lankle", 14: "chest",
+                15: "background" }
+
+
+class Keypoints:
+
+    # Decoded keypoints of a batch of frames: xy is an (N, parts, 2) array of frame
+    # coordinates and conf the (N, parts) heatmap peak values.
+    __slots__ = ('xy', 'conf', 'thr')
+
+    def __init__(self, xy, conf, thr):
+        self.xy = xy
+        self.conf = conf
+        self.thr = thr
+
+    def __len__(self):
+        return len(self.xy)
+
+    def __repr__(self):
+        return f'Keypoints({len(self)} frames, {self.xy.shape[1]} parts, thr={self.thr.__repr__()})'
+
+    @property
+    def found(self):
+        return self.conf > self.thr
+
+    def points(self, n):
+        # The points of frame n as the list of integer tuples (None when not found) used
+        # for drawing and skeleton dicts.
+        xy = self.xy[n].astype(int).tolist()
+        return [tuple(point) if found else None for (point, found) in zip(xy, self.found[n].tolist())]
+
+
+def decode_keypoints(out, sizes, thr=0.1, parts=None, refine=False, channels=None):
+    # Takes the global maximum of every heatmap of every frame at once. out is the
+    # (N, channels, H, W) network output, sizes holds the (width, height) of each frame and
+    # only the first `parts` channels are decoded. With refine, the peak is moved by the
+    # offset of a parabola fitted through its neighbours on each axis. channels restricts
+    # decoding to those parts, the others are left not found.
+    parts = out.shape[1] if parts is None else parts
+    (N, _, H, W) = out.shape
+    if channels is not None:
+        keypoints = decode_keypoints(out[:, channels], sizes, thr, len(channels), refine)
+        xy = np.zeros((N, parts, 2))
+        conf = np.full((N, parts), -np.inf, dtype=keypoints.conf.dtype)
+        xy[:, channels] = keypoints.xy
+        conf[:, channels] = keypoints.conf
+        return Keypoints(xy, conf, thr)
+    heatMaps = out[:, :parts].reshape(N, parts, H * W)
+    peak = heatMaps.argmax(axis=2)
+    conf = np.take_along_axis(heatMaps, peak[:, :, None], axis=2)[:, :, 0]
+    point = np.stack((peak % W, peak // W), axis=2).astype(float)
+
+    if refine:
+        for (axis, step, length) in ((0, 1, W), (1, W, H)):
+            inside = (point[:, :, axis] > 0) & (point[:, :, axis] < length - 1)
+            before = np.take_along_axis(heatMaps, np.where(inside, peak - step, peak)[:, :, None], axis=2)[:, :, 0]
+            after = np.take_along_axis(heatMaps, np.where(inside, peak + step, peak)[:, :, None], axis=2)[:, :, 0]
+            curvature = before - 2 * conf + after
+            offset = np.where(inside & (curvature < 0), (before - after) / (2 * np.where(curvature < 0, curvature, -1)), 0)
+            point[:, :, axis] += np.clip(offset, -0.5, 0.5)
+
+    sizes = np.asarray(sizes, dtype=float).reshape(N, 1, 2)
+    xy = (sizes * point) / np.array([W, H], dtype=float)
+    return Keypoints(xy, conf, thr)
+
+
+def find_peaks(heatMaps, thr=0.1):
+    # Non-maximum suppression over every heatmap at once: a pixel is a peak when it is above
+    # the threshold and not lower than any of its 8 neighbours.
+    (H, W) = heatMaps.shape[-2:]
+    padded = np.pad(heatMaps, [(0, 0)] * (heatMaps.ndim - 2) + [(1, 1), (1, 1)], constant_values=-np.inf)
+    neighbours = np.full(heatMaps.shape, -np.inf, dtype=heatMaps.dtype)
+    for dy in (0, 1, 2):
+        for dx in (0, 1, 2):
+            if dy != 1 or dx != 1:
+                np.maximum(neighbours, padded[..., dy:dy + H, dx:dx + W], out=neighbours)
+    return (heatMaps > thr) & (heatMaps >= neighbours)
+
+
+def score_connections(pafX, pafY, candFrom, candTo, samples=10, paf_thr=0.05):
+    # Line integral of the part affinity field between every (from, to) candidate pair,
+    # sampled at `samples` points along each segment. Returns the (from, to) score matrix,
+    # with -inf for pairs the field does not support.
+    (H, W) = pafX.shape
+    d = candTo[None, :, :2] - candFrom[:, None, :2]
+    norm = np.sqrt((d ** 2).sum(axis=2))
+    unit = d / np.maximum(norm, 1e-6)[:, :, None]
+    t = np.linspace(0, 1, samples)
+    pts = candFrom[:, None, None, :2] + t[None, None, :, None] * d[:, :, None, :]
+    ix = np.clip(np.rint(pts[..., 0]).astype(int), 0, W - 1)
+    iy = np.clip(np.rint(pts[..., 1]).astype(int), 0, H - 1)
+    dots = pafX[iy, ix] * unit[:, :, None, 0] + pafY[iy, ix] * unit[:, :, None, 1]
+    score = dots.mean(axis=2) + np.minimum(0, 0.5 * H / np.maximum(norm, 1e-6) - 1)
+    supported = ((dots > paf_thr).mean(axis=2) >= 0.8) & (score > 0)
+    return np.where(supported, score, -np.inf)
+
+
+def group_people(candidates, connections, parts, min_parts=3):
+    # Assembles people from the accepted (from, to) candidate connections of each pair,
+    # taken in POSE_PAIRS order. A person is an array of candidate indexes per part.
+    people = []
+    owner = {}
+    for (partFrom, partTo, links) in connections:
+        for (i, j) in links:
+            a = owner.get((partFrom, i))
+            b = owner.get((partTo, j))
+            if a is None and b is None:
+                person = np.full(parts, -1)
+                person[partFrom] = i
+                person[partTo] = j
+                people.append(person)
+                owner[(partFrom, i)] = owner[(partTo, j)] = len(people) - 1
+            elif b is None:
+                if people[a][partTo] < 0:
+                    people[a][partTo] = j
+                    owner[(partTo, j)] = a
+            elif a is None:
+                if people[b][partFrom] < 0:
+                    people[b][partFrom] = i
+                    owner[(partFrom, i)] = b
+            elif a != b and not ((people[a] >= 0) & (people[b] >= 0)).any():
+                people[a] = np.maximum(people[a], people[b])
+                for (key, value) in owner.items():
+                    if value == b:
+                        owner[key] = a
+                people[b] = np.full(parts, -1)
+    return [person for person in people if (person >= 0).sum() >= min_parts]
+
+
+def decode_people(out, sizes, names, pairs, pafs, thr=0.1, paf_thr=0.05, min_parts=3):
+    # Multi-person decoding: local maxima of every heatmap are candidate joints, which are
+    # linked into skeletons by their part affinity field scores. Returns, for every frame,
+    # a list of skeleton dicts keyed by `names`. pairs holds the (from, to) part indexes
+    # of each limb and pafs its two field channels.
+    parts = len(names)
+    (N, _, H, W) = out.shape
+    peaks = find_peaks(out[:, :parts], thr)
+    (n_idx, c_idx, y_idx, x_idx) = np.nonzero(peaks)
+    values = out[n_idx, c_idx, y_idx, x_idx]
+    bounds = np.searchsorted(n_idx * parts + c_idx, np.arange(N * parts + 1))
+
+    frames = []
+    for n in range(N):
+        candidates = []
+        for c in range(parts):
+            (lo, hi) = (bounds[n * parts + c], bounds[n * parts + c + 1])
+            candidates.append(np.stack((x_idx[lo:hi], y_idx[lo:hi], values[lo:hi]), axis=1).astype(float))
+
+        connections = []
+        for ((partFrom, partTo), (cx, cy)) in zip(pairs, pafs):
+            (candFrom, candTo) = (candidates[partFrom], candidates[partTo])
+            links = []
+            if len(candFrom) and len(candTo):
+                scores = score_connections(out[n, cx], out[n, cy], candFrom, candTo, paf_thr=paf_thr)
+                order = np.argsort(-scores, axis=None)
+                (usedFrom, usedTo) = (set(), set())
+                for (i, j) in zip(*np.unravel_index(order[:np.isfinite(scores).sum()], scores.shape)):
+                    if i not in usedFrom and j not in usedTo:
+                        links.append((i, j))
+                        usedFrom.add(i)
+                        usedTo.add(j)
+                        if len(links) == min(len(candFrom), len(candTo)):
+                            break
+            connections.append((partFrom, partTo, links))
+
+        (frameWidth, frameHeight) = sizes[n]
+        skeletons = []
+        for person in group_people(candidates, connections, parts, min_parts):
+            skeleton = {}
+            for (c, name) in enumerate(names):
+                if person[c] < 0:
+                    skeleton[name] = None
+                else:
+                    (x, y, conf) = candidates[c][person[c]]
+                    skeleton[name] = (int((frameWidth * x) / W), int((frameHeight * y) / H))
+            skeletons.append(skeleton)
+        frames.append(skeletons)
+    return frames
+
+
+class PoseEstimator:
+
+    # The network and the body tables are loaded once, so that a single estimator can be
+    # reused for every frame of a video. With joints, e.g. the joint_ids of a PoseLibrary,
+    # only the heatmaps of those joints are decoded and the other joints are None. With a
+    # pose_cache.InferenceCache, or the parameters of one, images already seen skip the
+    # network.
+    def __init__(self, proto='pose/mpi/pose_deploy_linevec_faster_4_stages.prototxt', model='pose/mpi/pose_iter_160000.caffemodel', dataset='MPI', thr=0.1, width=368, height=368, batch_size=8, refine=False, joints=None, cache=None):
+        self.proto = proto
+        self.model = model
+        self.dataset = dataset
+        self.thr = thr
+        self.width = width
+        self.height = height
+        self.batch_size = batch_size
+        self.refine = refine
+        (self.BODY_PARTS, self.POSE_PAIRS) = body_tables(dataset)
+        self.PAF_PAIRS = paf_tables(dataset)
+        self.joints = None if joints is None else tuple(sorted(joints))
+        self.channels = decoded_channels(self.BODY_PARTS, self.joints)
+        self.cache = InferenceCache(*cache) if isinstance(cache, tuple) else cache
+        self.net = cv.dnn.readNetFromCaffe(proto, model)
+
+    def parameters(self):
+        # Enough to build an identical estimator, e.g. in another process, where the cache
+        # is a new one with the same settings and disk tier.
+        cache = None if self.cache is None else self.cache.parameters()
+        return (self.proto, self.model, self.dataset, self.thr, self.width, self.height, self.batch_size, self.refine, self.joints, cache)
+
+    def estimate_path(self, inputim, retframe=False):
+        return self.estimate(cv.imread(inputim), retframe)
+
+    def estimate(self, frame, retframe=False, retconf=False):
+        inp = cv.dnn.blobFromImage(frame, 1.0 / 255, (self.width, self.height),
+                                  (0, 0, 0), swapRB=False, crop=False)
+        keypoints = self.decode(self.forward(inp), [frame])
+        return self.result(frame, keypoints.points(0), retframe, keypoints.conf[0] if retconf else None)
+
+    def estimate_batch(self, frames, retframe=False, batch_size=None):
+        # Frames are stacked into blobs of batch_size images, each going through a single
+        # forward pass, and the output is split back into one result per frame.
+        results = []
+        for (batch, keypoints) in self.keypoint_batches(frames, batch_size):
+            for (n, frame) in enumerate(batch):
+                results.append(self.result(frame, keypoints.points(n), retframe))
+        return results
+
+    def keypoint_batches(self, frames, batch_size=None):
+        # Yields each batch of frames along with its decoded Keypoints.
+        batch_size = batch_size or self.batch_size
+        frames = iter(frames)
+        batch = list(itertools.islice(frames, batch_size))
+        while batch:
+            inp = cv.dnn.blobFromImages(batch, 1.0 / 255, (self.width, self.height),
+                                       (0, 0, 0), swapRB=False, crop=False)
+            yield (batch, self.decode(self.forward(inp), batch))
+            batch = list(itertools.islice(frames, batch_size))
+
+    def estimate_people(self, frame):
+        # All the skeletons found in the frame, as a list of skeleton dicts.
+        return self.estimate_people_batch([frame])[0]
+
+    def estimate_people_batch(self, frames, batch_size=None):
+        if self.PAF_PAIRS is None:
+            raise ValueError(f'Multi-person decoding is not supported for the {self.dataset} dataset')
+        batch_size = batch_size or self.batch_size
+        names = joint_names(self.BODY_PARTS)[:-1]
+        pairs = [(self.BODY_PARTS[partFrom], self.BODY_PARTS[partTo]) for (partFrom, partTo) in self.POSE_PAIRS]
+        frames = iter(frames)
+        results = []
+        batch = list(itertools.islice(frames, batch_size))
+        while batch:
+            inp = cv.dnn.blobFromImages(batch, 1.0 / 255, (self.width, self.height),
+                                       (0, 0, 0), swapRB=False, crop=False)
+            sizes = [(frame.shape[1], frame.shape[0]) for frame in batch]
+            results.extend(decode_people(self.forward(inp), sizes, names, pairs, self.PAF_PAIRS, self.thr))
+            batch = list(itertools.islice(frames, batch_size))
+        return results
+
+    def forward(self, inp):
+        if self.cache is not None:
+            return self.cached_forward(inp)
+        self.net.setInput(inp)
+        start_t = time.time()
+        out = self.net.forward()
     
-    frame = cv.imread(args['inputim'])
-    frameWidth = frame.shape[1]
-    frameHeight = frame.shape[0]
-
-    inp = cv.dnn.blobFromImage(frame, 1.0 / 255, (inWidth, inHeight),
-                              (0, 0, 0), swapRB=False, crop=False)
-    net.setInput(inp)
-    start_t = time.time()
-    out = net.forward()
-    
-    print("time is ",time.time()-start_t)
-    # print(inp.shape)
-    #kwinName="Pose Estimation Demo: Cv-Tricks.com"
-    #cv.namedWindow(kwinName, cv.WINDOW_AUTOSIZE)
-    #assert(len(BODY_PARTS) == out.shape[1])
+        print("time is ",time.time()-start_t)
+        return out
 
-    points = []
-    for i in range(len(BODY_PARTS)):
-        # Slice heatmap of corresponging body's part.
-        heatMap = out[0, i, :, :]
+    def cached_forward(self, inp):
+        # Only the images of the blob missing from the cache go through the network, once
+        # even when the blob holds the same image several times.
+        parameters = (self.proto, self.model, self.width, self.height)
+        keys = [self.cache.key(image, parameters) for image in inp]
+        first = {}
+        for (n, key) in enumerate(keys):
+            first.setdefault(key, n)
+        outputs = {key: self.cache.get(key) for key in first}
+        missing = [key for (key, output) in outputs.items() if output is None]
+        if missing:
+            self.net.setInput(np.ascontiguousarray(inp[[first[key] for key in missing]]))
+            out = self.net.forward()
+            for (key, output) in zip(missing, out):
+                self.cache.put(key, output)
+                outputs[key] = output
+        return np.stack([outputs[key] for key in keys])
 
+    def decode(self, out, frames):
         # Originally, we try to find all the local maximums. To simplify a sample
         # we just find a global one. However only a single pose at the same time
         # could be detected this way.
-        _, conf, _, point = cv.minMaxLoc(heatMap)
-        x = (frameWidth * point[0]) / out.shape[3]
-        y = (frameHeight * point[1]) / out.shape[2]
-
-        # Add a point if it's confidence is higher than threshold.
-        points.append((int(x), int(y)) if conf > args['thr'] else None)
-
-    body_joints = { 0: "head", 1: "neck",2: "rshoulder", 3: "relbow", 4: "rwrist",
-                    5: "lshoulder", 6: "lelbow", 7: "lwrist", 8: "rhip", 9: "rknee",
-                    10: "rankle", 11: "lhip", 12: "lknee", 13: "lankle", 14: "chest",
-                    15: "background" }
-
-    points_dict = {}
-    for i in range(len(body_joints)):
-        points_dict[body_joints[i]] = points[i]
-    if not retframe:
-        return points_dict
-    else:
-        for pair in POSE_PAIRS:
+        sizes = [(frame.shape[1], frame.shape[0]) for frame in frames]
+        return decode_keypoints(out, sizes, self.thr, len(self.BODY_PARTS), self.refine, self.channels)
+
+    def result(self, frame, points, retframe, conf=None):
+        # With conf, the heatmap peak values of the joints follow, as a dict keyed like
+        # the skeleton, -inf for joints that are not decoded.
+        points_dict = {}
+        for i in range(len(body_joints)):
+            points_dict[body_joints[i]] = points[i]
+        if conf is not None:
+            conf = {body_joints[i]: float(conf[i]) for i in range(len(body_joints))}
+            return (points_dict, self.draw(frame.copy(), points), conf) if retframe else (points_dict, conf)
+        if not retframe:
+            return points_dict
+        else:
+            return (points_dict, self.draw(frame.copy(), points))
+
+    def draw(self, frame, points):
+        for pair in self.POSE_PAIRS:
             partFrom = pair[0]
             partTo = pair[1]
-            assert(partFrom in BODY_PARTS)
-            assert(partTo in BODY_PARTS)
+            assert(partFrom in self.BODY_PARTS)
+            assert(partTo in self.BODY_PARTS)
 
-            idFrom = BODY_PARTS[partFrom]
-            idTo = BODY_PARTS[partTo]
+            idFrom = self.BODY_PARTS[partFrom]
+            idTo = self.BODY_PARTS[partTo]
             if points[idFrom] and points[idTo]:
                 cv.line(frame, points[idFrom], points[idTo], (255, 74, 0), 3)
                 cv.ellipse(frame, points[idFrom], (4, 4), 0, 0, 360, (255, 255, 255), cv.FILLED)
@@ -121,8 +418,18 @@ def pose_estimation(inputim, retframe=False, proto='pose/mpi/pose_deploy_linevec
                 cv.putText(frame, str(idTo), points[idTo], cv.FONT_HERSHEY_SIMPLEX, 0.75, (255, 255, 255),2,cv.LINE_AA)
 
         #These next lines are for displaying the time it took to process the image.
-        #t, _ = net.getPerfProfile()
+        #t, _ = self.net.getPerfProfile()
         #freq = cv.getTickFrequency() / 1000
         #cv.putText(frame, '%.2fms' % (t / freq), (10, 20), cv.FONT_HERSHEY_SIMPLEX, 0.75, (255, 255, 255),2,cv.LINE_AA)
 
-        return (points_dict, frame)
+        return frame
+
+
+@functools.lru_cache(maxsize=None)
+def shared_estimator(proto='pose/mpi/pose_deploy_linevec_faster_4_stages.prototxt', model='pose/mpi/pose_iter_160000.caffemodel', dataset='MPI', thr=0.1, width=368, height=368, batch_size=8, refine=False, joints=None, cache=None):
+    return PoseEstimator(proto, model, dataset, thr, width, height, batch_size, refine, joints, cache)
+
+
+def pose_estimation(inputim, retframe=False, proto='pose/mpi/pose_deploy_linevec_faster_4_stages.prototxt', model='pose/mpi/pose_iter_160000.caffemodel', dataset='MPI', thr=0.1, width=368, height=368):
+    estimator = shared_estimator(proto, model, dataset, thr, width, height)
+    return estimator.estimate_path(inputim, retframe)
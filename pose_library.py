@@ -0,0 +1,266 @@
+import heapq
+import math
+import numpy as np
+
+from pose_description import *
+
+
+def classify(skeleton, poses, k=1):
+    # The k best scoring poses as (pose, score) pairs, best first, earlier poses winning
+    # ties. Poses are scored against the k-th best score found so far, so the evaluation of
+    # an AndPose/OrPose tree stops as soon as it cannot make it into the top k.
+    context = skeleton if isinstance(skeleton, EvaluationContext) else EvaluationContext(skeleton)
+    best = []
+    if k < 1:
+        return best
+    for (order, pose) in enumerate(poses):
+        floor = best[0][0] if len(best) == k else -math.inf
+        score = pose.score_above(context, floor)
+        if score > floor:
+            if len(best) == k:
+                heapq.heapreplace(best, (score, -order, pose))
+            else:
+                heapq.heappush(best, (score, -order, pose))
+    return [(pose, score) for (score, order, pose) in sorted(best, reverse=True)]
+
+
+class PoseLibrary:
+
+    # Many named poses merged into a single DAG: structurally identical subtrees, down to
+    # the leaf relations, are equal poses and become one node that is evaluated once per
+    # call, whichever and however many poses use it. Nodes are kept in evaluation order,
+    # children first.
+    AND, OR, NOT, LEAF = range(4)
+
+    def __init__(self, poses=(), relations=False):
+        # poses is a {pose: name} dict like pose_demo.POSES, or an iterable of poses. With
+        # relations=True, evaluate() looks the relation leaves up in a RelationTable of just
+        # those leaves, computed once per skeleton.
+        self.relations = relations
+        self.layout = None
+        self.nodes = []
+        self.program = []
+        self.slots = {}
+        self.poses = []
+        self.names = []
+        self.roots = []
+        # Joints read by any pose of the library, None when some pose reads unknown joints.
+        self.joint_ids = frozenset()
+        items = poses.items() if isinstance(poses, dict) else ((pose, repr(pose)) for pose in poses)
+        for (pose, name) in items:
+            self.add(pose, name)
+
+    def add(self, pose, name=None):
+        # Only the nodes the library does not have yet are added.
+        self.poses.append(pose)
+        self.names.append(repr(pose) if name is None else name)
+        self.roots.append(self.intern(pose))
+        self.layout = None
+        joints = pose.joints()
+        self.joint_ids = None if joints is None or self.joint_ids is None else self.joint_ids | joints
+
+    def intern(self, pose):
+        slot = self.slots.get(pose)
+        if slot is not None:
+            return slot
+        if isinstance(pose, AndPose):
+            step = (self.AND, self.intern(pose.first), self.intern(pose.second))
+        elif isinstance(pose, OrPose):
+            step = (self.OR, self.intern(pose.first), self.intern(pose.second))
+        elif isinstance(pose, NotPose):
+            step = (self.NOT, self.intern(pose.pose), None)
+        else:
+            step = (self.LEAF, None, None)
+        slot = self.slots[pose] = len(self.nodes)
+        self.nodes.append(pose)
+        self.program.append(step)
+        return slot
+
+    def __len__(self):
+        return len(self.poses)
+
+    def __repr__(self):
+        return f'PoseLibrary({len(self)} poses, {len(self.nodes)} nodes)'
+
+    def __call__(self, skeleton):
+        return self.evaluate(skeleton)
+
+    def relation_layout(self):
+        if self.layout is None:
+            self.layout = RelationLayout(pose for (pose, (op, a, b)) in zip(self.nodes, self.program) if op == self.LEAF)
+        return self.layout
+
+    def evaluate(self, skeleton):
+        # Scores of every pose of the library on one skeleton, in library order.
+        if isinstance(skeleton, EvaluationContext):
+            context = skeleton
+        else:
+            context = EvaluationContext(skeleton, self.relation_layout() if self.relations else False)
+        values = []
+        for (pose, (op, a, b)) in zip(self.nodes, self.program):
+            if op == self.AND:
+                values.append(min(values[a], values[b]))
+            elif op == self.OR:
+                values.append(max(values[a], values[b]))
+            elif op == self.NOT:
+                values.append(1 - values[a])
+            else:
+                values.append(context.score(pose))
+        return np.array([values[root] for root in self.roots], dtype=float)
+
+    def scores(self, skeleton):
+        return dict(zip(self.poses, self.evaluate(skeleton).tolist()))
+
+    def classify(self, skeleton, k=1):
+        return classify(skeleton, self.poses, k)
+
+    def compile(self, joints=MPI_JOINTS):
+        # Batched counterpart of evaluate: maps an (N, J, 2) array to (N, P) scores. The
+        # leaves are already vectorized over the batch, so relations does not apply here.
+        index = {joint: i for i, joint in enumerate(joints)}
+        leaves = [pose.lower(index) if op == self.LEAF else None
+                  for (pose, (op, a, b)) in zip(self.nodes, self.program)]
+        scales = any(pose.scales for pose in self.nodes)
+
+        def compiled(coords):
+            coords = np.asarray(coords, dtype=float)
+            if not self.roots:
+                return np.zeros((len(coords), 0))
+            scale = batch_body_scale(coords, index) if scales else None
+            values = []
+            for (leaf, (op, a, b)) in zip(leaves, self.program):
+                if op == self.AND:
+                    values.append(batch_and(values[a], values[b]))
+                elif op == self.OR:
+                    values.append(batch_or(values[a], values[b]))
+                elif op == self.NOT:
+                    values.append(1 - values[a])
+                else:
+                    values.append(leaf(coords, scale))
+            return np.stack([values[root] for root in self.roots], axis=1)
+        return compiled
+
+    def evaluate_batch(self, coords, joints=MPI_JOINTS):
+        return self.compile(joints)(coords)
+
+
+class IncrementalEvaluator:
+
+    # Scores a PoseLibrary over consecutive skeletons of a video, recomputing only what the
+    # motion since the previous frames can change. Every leaf reads a few joints, so the
+    # leaves of the joints that moved by more than epsilon are evaluated again, and so are
+    # the nodes above them whose children's values changed. A joint is compared with where
+    # it was when its leaves were last evaluated, so slow drift is caught once it adds up
+    # to epsilon. Leaves whose joints are unknown, like LambdaPose, are evaluated every
+    # frame. With epsilon=0 the scores are exactly those of PoseLibrary.evaluate. Poses
+    # added to the library later are picked up on the next call, which then starts over.
+    def __init__(self, poses, epsilon=0):
+        self.library = poses if isinstance(poses, PoseLibrary) else PoseLibrary(poses)
+        self.epsilon = epsilon
+        self.index()
+        self.reset()
+
+    def index(self):
+        library = self.library
+        self.size = (len(library.nodes), len(library.roots))
+        self.parents = [[] for _ in library.nodes]
+        for (slot, (op, a, b)) in enumerate(library.program):
+            for child in (a, b) if op in (library.AND, library.OR) else (a,) if op == library.NOT else ():
+                self.parents[child].append(slot)
+
+        # Leaves reading each joint, and leaves to evaluate every frame.
+        self.readers = {}
+        self.volatile = []
+        for (slot, (pose, (op, a, b))) in enumerate(zip(library.nodes, library.program)):
+            if op != library.LEAF:
+                continue
+            joints = pose.joints()
+            if joints is None:
+                self.volatile.append(slot)
+                continue
+            for joint in joints:
+                self.readers.setdefault(joint, []).append(slot)
+        self.joints = [joint for joint in MPI_JOINTS if joint in self.readers]
+        self.joints += sorted(joint for joint in self.readers if joint not in self.joints)
+
+    def reset(self):
+        self.values = None
+        self.reference = None
+        self.result = np.zeros(0)
+        self.evaluated = 0
+
+    def __call__(self, skeleton):
+        return self.evaluate(skeleton)
+
+    def moved(self, skeleton):
+        # Positions of the joints that moved by more than epsilon, or appeared or vanished.
+        epsilon = self.epsilon
+        moved = []
+        for (i, (joint, reference)) in enumerate(zip(self.joints, self.reference)):
+            point = skeleton.get(joint)
+            if point is None or reference is None:
+                if point is not reference:
+                    moved.append(i)
+            elif abs(point[0] - reference[0]) > epsilon or abs(point[1] - reference[1]) > epsilon:
+                moved.append(i)
+        return moved
+
+    def evaluate(self, skeleton):
+        # Same as PoseLibrary.evaluate. evaluated counts the nodes the call recomputed.
+        library = self.library
+        if self.size != (len(library.nodes), len(library.roots)):
+            self.index()
+            self.reset()
+        if self.values is None:
+            moved = range(len(self.joints))
+            dirty = [slot for (slot, (op, a, b)) in enumerate(library.program) if op == library.LEAF]
+        else:
+            moved = self.moved(skeleton)
+            dirty = set(self.volatile)
+            for i in moved:
+                dirty.update(self.readers[self.joints[i]])
+            dirty = list(dirty)
+        self.evaluated = 0
+        if dirty:
+            self.update(skeleton, dirty)
+            self.result = np.array([self.values[root] for root in library.roots], dtype=float)
+        if self.reference is None:
+            self.reference = [None] * len(self.joints)
+        for i in moved:
+            self.reference[i] = skeleton.get(self.joints[i])
+        return self.result.copy()
+
+    def update(self, skeleton, dirty):
+        # Nodes are numbered children first, so popping the smallest dirty slot always
+        # finds its children up to date.
+        library = self.library
+        first = self.values is None
+        values = [None] * len(library.nodes) if first else self.values
+        self.values = None
+        context = EvaluationContext(skeleton)
+        heapq.heapify(dirty)
+        queued = set(dirty)
+        while dirty:
+            slot = heapq.heappop(dirty)
+            (op, a, b) = library.program[slot]
+            if op == library.AND:
+                value = min(values[a], values[b])
+            elif op == library.OR:
+                value = max(values[a], values[b])
+            elif op == library.NOT:
+                value = 1 - values[a]
+            else:
+                # A leaf failing on a missing joint leaves values unknown, hence
+                # self.values = None above: the next call starts over.
+                value = library.nodes[slot].evaluate(context)
+            self.evaluated += 1
+            if first or value != values[slot]:
+                values[slot] = value
+                for parent in self.parents[slot]:
+                    if parent not in queued:
+                        queued.add(parent)
+                        heapq.heappush(dirty, parent)
+        self.values = values
+
+    def scores(self, skeleton):
+        return dict(zip(self.library.poses, self.evaluate(skeleton).tolist()))
@@ -0,0 +1,152 @@
+import queue
+import threading
+import time
+
+
+# Staged producer/consumer pipeline. Items flow through bounded queues between stages, so
+# a slow stage holds back the ones before it instead of letting work pile up in memory.
+# Every stage runs its function on its own pool of threads, which overlaps well with
+# OpenCV calls since those release the GIL.
+
+_DONE = object()
+
+
+class Stage:
+
+    def __init__(self, name, function, threads=1, maxsize=8):
+        self.name = name
+        self.function = function
+        self.threads = threads
+        self.maxsize = maxsize
+        self.reset()
+
+    def reset(self):
+        self.queue = queue.Queue(self.maxsize)
+        self.processed = 0
+        self.busy = 0.0
+        self.max_depth = 0
+        self.depth_total = 0
+        self.depth_samples = 0
+        self.lock = threading.Lock()
+        self.running = self.threads
+
+    def sample_depth(self):
+        depth = self.queue.qsize()
+        with self.lock:
+            self.max_depth = max(self.max_depth, depth)
+            self.depth_total += depth
+            self.depth_samples += 1
+
+    def metrics(self):
+        return {'threads': self.threads, 'depth': self.queue.qsize(), 'max_depth': self.max_depth,
+                'mean_depth': self.depth_total / self.depth_samples if self.depth_samples else 0.0,
+                'processed': self.processed, 'busy': self.busy}
+
+    def __repr__(self):
+        return f'Stage({self.name.__repr__()}, threads={self.threads}, maxsize={self.maxsize})'
+
+
+class Pipeline:
+
+    def __init__(self, stages, maxsize=8):
+        self.stages = stages
+        self.maxsize = maxsize
+
+    def metrics(self):
+        return {stage.name: stage.metrics() for stage in self.stages}
+
+    def run(self, items):
+        # Yields the output of the last stage, in the order of the input items.
+        for stage in self.stages:
+            stage.reset()
+        output = queue.Queue(self.maxsize)
+        stop = threading.Event()
+        errors = []
+        threads = [threading.Thread(target=self._feed, args=(items, stop, errors), daemon=True)]
+        for (i, stage) in enumerate(self.stages):
+            following = self.stages[i + 1] if i + 1 < len(self.stages) else None
+            for _ in range(stage.threads):
+                threads.append(threading.Thread(target=self._work, args=(stage, following, output, stop, errors), daemon=True))
+        for thread in threads:
+            thread.start()
+
+        pending = {}
+        expected = 0
+        try:
+            while True:
+                item = self._get(output, stop)
+                if item is None or item is _DONE:
+                    break
+                (seq, value) = item
+                pending[seq] = value
+                while expected in pending:
+                    yield pending.pop(expected)
+                    expected += 1
+            if errors:
+                raise errors[0]
+        finally:
+            stop.set()
+            for thread in threads:
+                thread.join()
+
+    def _feed(self, items, stop, errors):
+        first = self.stages[0]
+        try:
+            for item in enumerate(items):
+                if not self._put(first, item, stop):
+                    return
+        except Exception as error:
+            errors.append(error)
+            stop.set()
+            return
+        for _ in range(first.threads):
+            self._put(first, _DONE, stop)
+
+    def _work(self, stage, following, output, stop, errors):
+        while True:
+            item = self._get(stage.queue, stop)
+            if item is None:
+                return
+            if item is _DONE:
+                break
+            (seq, value) = item
+            start = time.perf_counter()
+            try:
+                value = stage.function(value)
+            except Exception as error:
+                errors.append(error)
+                stop.set()
+                return
+            with stage.lock:
+                stage.processed += 1
+                stage.busy += time.perf_counter() - start
+            if not self._put(following, (seq, value), stop, output):
+                return
+
+        with stage.lock:
+            stage.running -= 1
+            last = stage.running == 0
+        if last:
+            for _ in range(following.threads if following else 1):
+                self._put(following, _DONE, stop, output)
+
+    def _put(self, stage, item, stop, output=None):
+        # Blocks while the queue is full, which is what propagates backpressure upstream.
+        target = output if stage is None else stage.queue
+        while not stop.is_set():
+            try:
+                target.put(item, timeout=0.1)
+            except queue.Full:
+                continue
+            if stage is not None:
+                stage.sample_depth()
+            return True
+        return False
+
+    def _get(self, source, stop):
+        while not stop.is_set():
+            try:
+                return source.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return None
@@ -0,0 +1,138 @@
+import json
+import os
+import numpy as np
+
+from pose_description import *
+
+
+# On-disk skeleton store: a directory with a small JSON header naming the skeleton format
+# and one raw file per column, every row of a column having the same width:
+#   frame.i8   frame index                    int64
+#   time.f8    timestamp in seconds           float64
+#   xy.f4      (J, 2) joint coordinates       float32, NaN for joints not found
+#   conf.f4    (J,) joint confidences         float32, NaN when unknown
+# Rows are only ever appended, and the columns are read back as memory maps, so a store
+# can be re-scored without loading it, or while it is still being written.
+
+COLUMNS = {'frame': ('frame.i8', np.int64), 'time': ('time.f8', np.float64),
+           'xy': ('xy.f4', np.float32), 'conf': ('conf.f4', np.float32)}
+
+
+class SkeletonStore:
+
+    VERSION = 1
+
+    def __init__(self, path, format='MPI'):
+        # Opens the store at path, creating it with the given format if it does not exist.
+        self.path = path
+        header = os.path.join(path, 'header.json')
+        if os.path.exists(header):
+            with open(header) as file:
+                header = json.load(file)
+            if header['version'] != self.VERSION:
+                raise ValueError(f'Unsupported skeleton store version {header["version"]}')
+            self.format = skeleton_format(header['format'])
+            if header['joints'] != self.format.joints:
+                raise ValueError(f'Store joints do not match the {self.format.name} format')
+        else:
+            self.format = FORMATS[format] if isinstance(format, str) else format
+            os.makedirs(path, exist_ok=True)
+            with open(header, 'w') as file:
+                json.dump({'version': self.VERSION, 'format': self.format.name, 'joints': self.format.joints}, file)
+        self.files = None
+
+    def __repr__(self):
+        return f'SkeletonStore({self.path.__repr__()}, {len(self)} skeletons, format={self.format.name.__repr__()})'
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def width(self, column):
+        joints = len(self.format.joints)
+        return {'frame': 1, 'time': 1, 'xy': joints * 2, 'conf': joints}[column]
+
+    def append(self, frame, time, skeleton, conf=None):
+        # skeleton is a Skeleton or a skeleton dict, conf an optional (J,) array or a dict
+        # of joint confidences like the ones PoseEstimator.estimate returns.
+        coords = skeletons_to_array([skeleton], self.format.joints)
+        if isinstance(conf, dict):
+            conf = [conf.get(joint, np.nan) for joint in self.format.joints]
+        self.extend([frame], [time], coords, None if conf is None else [conf])
+
+    def extend(self, frames, times, coords, conf=None):
+        # Appends a batch of rows: coords is (N, J, 2) and conf (N, J), infinite confidences
+        # of joints that were not decoded being unknown.
+        coords = np.asarray(coords, dtype=np.float32).reshape(-1, len(self.format.joints), 2)
+        conf = np.full(coords.shape[:2], np.nan) if conf is None else np.asarray(conf, dtype=np.float32)
+        conf = np.where(np.isinf(conf), np.nan, conf)
+        if self.files is None:
+            self.files = {column: open(os.path.join(self.path, name), 'ab') for (column, (name, dtype)) in COLUMNS.items()}
+        for (column, values) in (('frame', frames), ('time', times), ('xy', coords), ('conf', conf)):
+            np.ascontiguousarray(values, dtype=COLUMNS[column][1]).tofile(self.files[column])
+
+    def flush(self):
+        if self.files is not None:
+            for file in self.files.values():
+                file.flush()
+
+    def close(self):
+        if self.files is not None:
+            for file in self.files.values():
+                file.close()
+            self.files = None
+
+    def __len__(self):
+        # Rows present in every column, so a row being written is not counted yet.
+        self.flush()
+        count = None
+        for (column, (name, dtype)) in COLUMNS.items():
+            path = os.path.join(self.path, name)
+            size = os.path.getsize(path) if os.path.exists(path) else 0
+            rows = size // (np.dtype(dtype).itemsize * self.width(column))
+            count = rows if count is None else min(count, rows)
+        return count
+
+    def column(self, column, count=None):
+        # Read-only memory map of the first count rows of a column.
+        count = len(self) if count is None else count
+        (name, dtype) = COLUMNS[column]
+        if count == 0:
+            return np.zeros((0, self.width(column)), dtype=dtype)
+        return np.memmap(os.path.join(self.path, name), dtype=dtype, mode='r', shape=(count, self.width(column)))
+
+    @property
+    def frames(self):
+        return self.column('frame')[:, 0]
+
+    @property
+    def times(self):
+        return self.column('time')[:, 0]
+
+    @property
+    def coords(self):
+        # (N, J, 2) coordinates, the input of compiled poses.
+        return self.column('xy').reshape(-1, len(self.format.joints), 2)
+
+    @property
+    def conf(self):
+        return self.column('conf')
+
+    def skeleton(self, i):
+        return Skeleton(self.coords[i], self.format)
+
+    def __iter__(self):
+        coords = self.coords
+        for i in range(len(coords)):
+            yield Skeleton(coords[i], self.format)
+
+    def evaluate(self, poses, chunk=65536):
+        # Scores of every stored skeleton, scoring chunk rows at a time through a compiled
+        # pose (N,) or anything with a batched compile like a PoseLibrary (N, P), so only a
+        # chunk of the store is in memory at once.
+        compiled = poses.compile(self.format.joints)
+        coords = self.coords
+        return np.concatenate([compiled(coords[i:i + chunk]) for i in range(0, len(coords), chunk)]
+                              or [compiled(coords[:0])])
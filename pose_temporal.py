@@ -0,0 +1,253 @@
+import numpy as np
+
+from pose_description import *
+from pose_library import PoseLibrary
+
+
+class PoseEvent:
+
+    __slots__ = ('kind', 'pose', 'name', 'frame', 'score')
+
+    def __init__(self, kind, pose, name, frame, score):
+        self.kind = kind
+        self.pose = pose
+        self.name = name
+        self.frame = frame
+        self.score = score
+
+    def __eq__(self, other):
+        if not isinstance(other, PoseEvent):
+            return NotImplemented
+        return (self.kind, self.pose, self.frame) == (other.kind, other.pose, other.frame)
+
+    def __repr__(self):
+        return f'PoseEvent({self.kind.__repr__()}, {self.name.__repr__()}, frame={self.frame}, score={self.score:.3f})'
+
+
+class PoseStream:
+
+    # Follows many poses over a stream of skeletons, one skeleton at a time. The score of
+    # every pose is smoothed by an exponential moving average, and a pose starts once its
+    # smoothed score reaches `on` and ends once it falls to `off`. Keeping off below on
+    # stops a pose hovering around a single threshold from flickering. The state is one
+    # smoothed score and one flag per pose, whatever the length of the stream.
+    STARTED = 'started'
+    ENDED = 'ended'
+
+    def __init__(self, poses, alpha=0.5, on=0.8, off=0.6):
+        # poses is a PoseLibrary, or what a PoseLibrary is built from.
+        if off > on:
+            raise ValueError(f'off threshold {off} above on threshold {on}')
+        self.library = poses if isinstance(poses, PoseLibrary) else PoseLibrary(poses)
+        self.alpha = alpha
+        self.on = on
+        self.off = off
+        self.reset()
+
+    def reset(self):
+        self.smoothed = np.zeros(len(self.library))
+        self.active = np.zeros(len(self.library), dtype=bool)
+        self.frame = 0
+        self.primed = False
+
+    def __call__(self, skeleton):
+        return self.update(skeleton)
+
+    def update(self, skeleton):
+        # Events of the skeleton, in library order. A skeleton missing joints leaves every
+        # pose as it was.
+        try:
+            scores = self.library.evaluate(skeleton)
+        except TypeError:
+            scores = None
+        return self.update_scores(scores)
+
+    def update_scores(self, scores):
+        # Same as update, for scores already computed in library order, e.g. a row of
+        # PoseLibrary.evaluate_batch. None stands for a frame without a skeleton.
+        if scores is not None:
+            if self.primed:
+                self.smoothed += self.alpha * (np.asarray(scores, dtype=float) - self.smoothed)
+            else:
+                self.smoothed[:] = scores
+                self.primed = True
+        started = ~self.active & (self.smoothed >= self.on)
+        ended = self.active & (self.smoothed <= self.off)
+        events = []
+        if started.any() or ended.any():
+            self.active ^= started | ended
+            for i in np.flatnonzero(started | ended):
+                events.append(PoseEvent(self.STARTED if started[i] else self.ENDED, self.library.poses[i],
+                                        self.library.names[i], self.frame, float(self.smoothed[i])))
+        self.frame += 1
+        return events
+
+    def events(self, skeletons):
+        # Every event of a stream of skeletons, as they happen.
+        for skeleton in skeletons:
+            yield from self.update(skeleton)
+
+    def state(self):
+        return {name: (float(score), bool(active))
+                for (name, score, active) in zip(self.library.names, self.smoothed, self.active)}
+
+    def __repr__(self):
+        return f'PoseStream({len(self.library)} poses, alpha={self.alpha}, on={self.on}, off={self.off})'
+
+
+class Gesture:
+
+    # A sequence of poses. Every step is a (pose, hold, within) triple: the pose has to match
+    # for at least hold seconds and, after the first step, start matching at most within
+    # seconds after the previous step last matched (None for no limit). Build one with
+    # gesture() and chain then(), held_for() and within(), the last two applying to the
+    # last step:
+    #     gesture(TPOSE).held_for(2)
+    #     gesture(RAISED).then(~RAISED).within(1)
+    def __init__(self, steps):
+        self.steps = tuple(steps)
+
+    def then(self, other, within=None):
+        other = other if isinstance(other, Gesture) else gesture(other)
+        ((pose, hold, _),) = other.steps[:1]
+        return Gesture(self.steps + ((pose, hold, within),) + other.steps[1:])
+
+    def held_for(self, seconds):
+        (pose, hold, within) = self.steps[-1]
+        return Gesture(self.steps[:-1] + ((pose, seconds, within),))
+
+    def within(self, seconds):
+        if len(self.steps) < 2:
+            raise ValueError('within() limits the delay after a previous step')
+        (pose, hold, within) = self.steps[-1]
+        return Gesture(self.steps[:-1] + ((pose, hold, seconds),))
+
+    def __len__(self):
+        return len(self.steps)
+
+    def __eq__(self, other):
+        return isinstance(other, Gesture) and self.steps == other.steps
+
+    def __hash__(self):
+        return hash(self.steps)
+
+    def __repr__(self):
+        return f'Gesture({list(self.steps).__repr__()})'
+
+
+def gesture(pose):
+    return Gesture(((pose, 0, None),))
+
+
+class GestureMatch:
+
+    __slots__ = ('gesture', 'name', 'start', 'end')
+
+    def __init__(self, gesture, name, start, end):
+        self.gesture = gesture
+        self.name = name
+        self.start = start
+        self.end = end
+
+    def __eq__(self, other):
+        if not isinstance(other, GestureMatch):
+            return NotImplemented
+        return (self.gesture, self.start, self.end) == (other.gesture, other.start, other.end)
+
+    def __repr__(self):
+        return f'GestureMatch({self.name.__repr__()}, start={self.start}, end={self.end})'
+
+
+class GestureMatcher:
+
+    # Matches gestures online, one skeleton at a time, without keeping past frames. Every
+    # gesture is a chain automaton with one state per step, waiting for that step; a state
+    # holds at most one partial match, the most recent, since it has the latest deadline.
+    # The poses of every step of every gesture are scored together through a PoseLibrary,
+    # and a pose is on when it scores at least tolerance. A frame costs one pass over the
+    # steps.
+    def __init__(self, gestures, fps=30, tolerance=.8):
+        # gestures is a {gesture: name} dict, or an iterable of gestures.
+        items = gestures.items() if isinstance(gestures, dict) else ((g, repr(g)) for g in gestures)
+        self.gestures = []
+        self.names = []
+        for (g, name) in items:
+            self.gestures.append(g)
+            self.names.append(name)
+        self.fps = fps
+        self.tolerance = tolerance
+        self.library = PoseLibrary(dict.fromkeys(pose for g in self.gestures for (pose, hold, within) in g.steps))
+        slots = {pose: i for (i, pose) in enumerate(self.library.poses)}
+        # Steps of every gesture laid end to end: (gesture, pose slot, hold, within, first, last).
+        self.steps = [(g, slots[pose], hold, within, i == 0, i == len(self.gestures[g].steps) - 1)
+                      for g in range(len(self.gestures))
+                      for (i, (pose, hold, within)) in enumerate(self.gestures[g].steps)]
+        self.reset()
+
+    def reset(self):
+        count = len(self.steps)
+        self.started = [None] * count      # start of the partial match waiting at the step
+        self.last = [None] * count         # when the previous step last matched
+        self.runs = [None] * count         # since when the step's pose has been on
+        self.done = [False] * count        # whether the current run completed the step
+        self.frame = 0
+
+    def __call__(self, skeleton, time=None):
+        return self.update(skeleton, time)
+
+    def update(self, skeleton, time=None):
+        # Gestures completed by the skeleton. time is in seconds, by default the frame
+        # number over fps. A skeleton missing joints turns every pose off.
+        try:
+            scores = self.library.evaluate(skeleton)
+        except TypeError:
+            scores = None
+        return self.update_scores(scores, time)
+
+    def update_scores(self, scores, time=None):
+        # Same as update, for the scores of library.poses already computed.
+        t = self.frame / self.fps if time is None else time
+        on = [False] * len(self.library) if scores is None else [score >= self.tolerance for score in scores]
+        matches = []
+        # Later steps first, so that a partial match moves at most one step per frame.
+        for s in range(len(self.steps) - 1, -1, -1):
+            (g, slot, hold, within, first, last) = self.steps[s]
+            waiting = first or self.started[s] is not None
+            if not on[slot] or not waiting:
+                if self.done[s] and not first:
+                    self.started[s] = None
+                self.runs[s] = None
+                self.done[s] = False
+                if waiting and not first and within is not None and t - self.last[s] > within:
+                    self.started[s] = None
+                continue
+            if self.runs[s] is None:
+                if not first and within is not None and t - self.last[s] > within:
+                    self.started[s] = None
+                    continue
+                self.runs[s] = t
+            if t - self.runs[s] < hold:
+                continue
+            start = self.runs[s] if first else self.started[s]
+            if last:
+                # A gesture matches once per run of its last pose.
+                if not self.done[s]:
+                    matches.append(GestureMatch(self.gestures[g], self.names[g], start, t))
+                    self.done[s] = True
+                    if not first:
+                        self.started[s] = None
+            else:
+                # While the step keeps matching, the next one keeps being offered a fresh
+                # deadline.
+                self.done[s] = True
+                self.started[s + 1] = start
+                self.last[s + 1] = t
+        self.frame += 1
+        return matches[::-1]
+
+    def matches(self, skeletons):
+        for skeleton in skeletons:
+            yield from self.update(skeleton)
+
+    def __repr__(self):
+        return f'GestureMatcher({len(self.gestures)} gestures, {len(self.steps)} steps)'
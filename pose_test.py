@@ -1,5 +1,25 @@
+import gc
+import os
+import pickle
+import random
+import re
+import tempfile
+import time
 import unittest
+import weakref
+from unittest import mock
+import cv2 as cv
+import numpy as np
+import pose_demo
+import pose_description
 from pose_description import *
+from pose_library import IncrementalEvaluator, PoseLibrary, classify
+from pose_cache import InferenceCache
+from pose_estimation import Keypoints, PoseEstimator, body_joints, body_tables, decode_keypoints, decode_people, decoded_channels, find_peaks, joint_names, paf_tables, pose_estimation, shared_estimator
+from pose_pipeline import Pipeline, Stage
+from pose_store import SkeletonStore
+from pose_temporal import GestureMatch, GestureMatcher, PoseEvent, PoseStream, gesture
+from pose_tracking import KeyframeEstimator, keyframe_report
 
 class JointTest(unittest.TestCase):
 
@@ -60,31 +80,58 @@ class JointTest(unittest.TestCase):
         self.assertTrue(a > b > c)
 
     def test_is_near(self):
-        pass
+        a = self.j2.is_near(self.j, 20)
+        b = self.j1.is_near(self.j, 20)
+        c = self.j3.is_near(self.j, 20)
+        self.assertTrue(a > b > c)
 
     def test_is_near_all(self):
-        pass
+        a = self.j2.is_near(self.s, 20)
+        b = self.j3.is_near(self.s, 20)
+        c = self.j1.is_near(self.s, 20)
+        self.assertTrue(a > b > c)
 
     def test_is_far(self):
-        pass
+        a = self.j3.is_far(self.j, 20)
+        b = self.j1.is_far(self.j, 20)
+        c = self.j2.is_far(self.j, 20)
+        self.assertTrue(a > b > c)
 
     def test_is_far_all(self):
-        pass
+        a = self.j1.is_far(self.s, 20)
+        b = self.j3.is_far(self.s, 20)
+        c = self.j2.is_far(self.s, 20)
+        self.assertTrue(a > b > c)
 
     def test_at_same_height(self):
-        pass
+        a = self.j2.at_same_height(self.j, 40)
+        b = self.j1.at_same_height(self.j, 40)
+        c = self.j3.at_same_height(self.j, 40)
+        self.assertTrue(a > b > c)
 
     def test_at_same_height_all(self):
-        pass
+        a = self.j2.at_same_height(self.s, 40)
+        b = self.j1.at_same_height(self.s, 40)
+        c = self.j3.at_same_height(self.s, 40)
+        self.assertTrue(a > b >= c)
 
     def test_at_same_width(self):
-        pass
+        a = self.j2.at_same_width(self.j, 40)
+        b = self.j1.at_same_width(self.j, 40)
+        c = self.j3.at_same_width(self.j, 40)
+        self.assertTrue(a > b >= c)
 
     def test_at_same_width_all(self):
-        pass
+        a = self.j2.at_same_width(self.s, 40)
+        b = self.j3.at_same_width(self.s, 40)
+        c = self.j1.at_same_width(self.s, 40)
+        self.assertTrue(a > b > c)
 
     def test_aligned_with(self):
-        pass
+        a = self.j2.aligned_with(self.s, 20)
+        b = self.j1.aligned_with(self.s, 20)
+        c = self.j3.aligned_with(self.s, 20)
+        self.assertTrue(a > b > c)
 
 class SegmentTest(unittest.TestCase):
 
@@ -159,6 +206,22 @@ class SegmentTest(unittest.TestCase):
         d = self.s1.to_the_left(self.s)
         self.assertTrue(a > b > c >= d)
 
+    def test_points_to(self):
+        a = self.s.points_to(Joint("", 20, 5))
+        b = self.s.points_to(Joint("", 19, 7))
+        c = self.s.points_to(Joint("", 20, 10))
+        self.assertTrue(a > b > c)
+
+    def test_crosses(self):
+        self.assertEqual(self.s.crosses(Segment(Joint('', 10, 10), Joint('', 15, 15))), 1)
+        self.assertEqual(self.s.crosses(self.s1), 0)
+
+    def test_parallel(self):
+        a = self.s1.parallel(self.s2)
+        b = self.s1.parallel(Segment(Joint('', 0, 0), Joint('', 10, 12)))
+        c = self.s1.parallel(self.s)
+        self.assertTrue(a > b > c)
+
 
 class LimbTest(unittest.TestCase):
 
@@ -232,3 +295,1063 @@ class LimbTest(unittest.TestCase):
         c = self.s2.to_the_left(self.l)
         d = self.s1.to_the_left(self.l)
         self.assertTrue(a > b > c >= d)
+
+    def test_straight(self):
+        straight = Limb([Joint('', 0, 0), Joint('', 5, 5), Joint('', 10, 10)])
+        bent = Limb([Joint('', 0, 0), Joint('', 5, 5), Joint('', 10, 11)])
+        folded = Limb([Joint('', 0, 0), Joint('', 5, 5), Joint('', 10, 5)])
+        self.assertTrue(straight.parallel(straight) > bent.parallel(bent) > folded.parallel(folded))
+
+
+def random_skeletons(count, seed=0, integer=True):
+    rng = random.Random(seed)
+    draw = (lambda: rng.randint(0, 400)) if integer else (lambda: rng.uniform(0, 400))
+    return [{joint: (draw(), draw()) for joint in MPI_JOINTS} for _ in range(count)]
+
+
+class CompiledPoseTest(unittest.TestCase):
+
+    def setUp(self):
+        self.poses = [
+            Body.left_arm.to_the_right(Body.left_shoulder) & Body.right_arm.to_the_left(Body.right_shoulder),
+            Body.right_forearm.above(Body.head) & Body.left_arm.below(Body.head),
+            Body.left_knee.above(Body.left_hip) | Body.right_knee.above(Body.right_hip),
+            ~Body.right_wrist.to_the_right(Body.left_leg) | Body.torso.below(Body.face),
+            Body.left_leg.to_the_left(Body.right_calf) & ~Body.head.above(Body.neck),
+        ]
+
+    def test_matches_scalar_path(self):
+        for integer in (True, False):
+            skeletons = random_skeletons(50, integer=integer)
+            coords = skeletons_to_array(skeletons)
+            for pose in self.poses:
+                expected = [pose(skeleton) for skeleton in skeletons]
+                self.assertEqual(pose.compile()(coords).tolist(), expected)
+
+    def test_lambda_pose(self):
+        skeletons = random_skeletons(5)
+        pose = LambdaPose(lambda skeleton: skeleton['head'][1] / 400) & Body.head.above(Body.chest)
+        expected = [pose(skeleton) for skeleton in skeletons]
+        self.assertEqual(compile_pose(pose)(skeletons_to_array(skeletons)).tolist(), expected)
+
+    def test_geometry(self):
+        poses = [
+            Body.right_wrist.is_near(Body.head) & Body.left_arm.is_far(Body.right_leg),
+            Body.right_wrist.at_same_height(Body.left_wrist) | Body.face.at_same_width(Body.torso),
+            Body.right_forearm.points_to(Body.head) | Body.head.aligned_with(Body.torso),
+            Body.right_arm.straight() & ~Body.right_forearm.crosses(Body.left_forearm),
+        ]
+        skeletons = random_skeletons(50, integer=False)
+        coords = skeletons_to_array(skeletons)
+        for pose in poses:
+            expected = [pose(skeleton) for skeleton in skeletons]
+            self.assertEqual(pose.compile()(coords).tolist(), expected)
+            self.assertEqual([pose(EvaluationContext(skeleton)) for skeleton in skeletons], expected)
+            self.assertEqual([pose.compile_scalar()(skeleton) for skeleton in skeletons], expected)
+
+    def test_body_scale_computed_once(self):
+        pose = (Body.right_wrist.is_near(Body.head) & Body.left_arm.is_far(Body.right_leg)) | Body.head.aligned_with(Body.torso)
+        skeletons = random_skeletons(20, integer=False)
+        library = PoseLibrary([pose, ~Body.right_wrist.is_near(Body.head)])
+        with mock.patch('pose_description.batch_body_scale', wraps=pose_description.batch_body_scale) as batch, \
+             mock.patch('pose_library.batch_body_scale', batch):
+            pose.compile()(skeletons_to_array(skeletons))
+            self.assertEqual(batch.call_count, 1)
+            library.evaluate_batch(skeletons_to_array(skeletons))
+            self.assertEqual(batch.call_count, 2)
+        with mock.patch('pose_description.body_scale', wraps=pose_description.body_scale) as scalar:
+            computed = lambda: sum(not isinstance(args[0], EvaluationContext) for (args, kwargs) in scalar.call_args_list)
+            pose(skeletons[0])
+            self.assertEqual(computed(), 1)
+            library.evaluate(skeletons[0])
+            self.assertEqual(computed(), 2)
+        self.assertEqual(len(re.findall(r'\bs\d+ = ', pose.compile_scalar().source)), 1)
+
+    def test_reused_buffer(self):
+        # new coordinates written into the same array get their own body scales
+        pose = Body.right_wrist.is_near(Body.head) | Body.left_arm.at_same_height(Body.right_arm)
+        (first, second) = (random_skeletons(20, integer=False), random_skeletons(20, seed=1, integer=False))
+        compiled = pose.compile()
+        library = PoseLibrary([pose]).compile()
+        buffer = skeletons_to_array(first)
+        compiled(buffer)
+        library(buffer)
+        buffer[:] = skeletons_to_array(second)
+        expected = [pose(skeleton) for skeleton in second]
+        self.assertEqual(compiled(buffer).tolist(), expected)
+        self.assertEqual(library(buffer)[:, 0].tolist(), expected)
+
+    def test_custom_pose(self):
+        # poses without array kernels are scored row by row
+        class Touches(Pose):
+            def evaluate(self, skeleton):
+                return self.first(skeleton).is_near(self.second(skeleton), 10)
+        pose = Touches(Body.head, Body.neck) | Body.head.above(Body.neck)
+        skeletons = random_skeletons(20, integer=False)
+        expected = [pose(skeleton) for skeleton in skeletons]
+        self.assertEqual(pose.compile()(skeletons_to_array(skeletons)).tolist(), expected)
+        self.assertEqual(PoseLibrary([pose]).evaluate_batch(skeletons_to_array(skeletons))[:, 0].tolist(), expected)
+
+    def test_missing_joints(self):
+        # a row scores NaN exactly when scoring the skeleton alone raises a TypeError
+        poses = self.poses + [
+            Body.right_wrist.is_near(Body.head) | Body.left_arm.crosses(Body.right_leg),
+            Body.head.above(Body.neck) & LambdaPose(lambda skeleton: skeleton['lwrist'][1] / 400),
+        ]
+        skeletons = random_skeletons(200, seed=3)
+        rng = random.Random(4)
+        for skeleton in skeletons:
+            for joint in rng.sample(MPI_JOINTS, rng.randint(0, 3)):
+                skeleton[joint] = None
+        coords = skeletons_to_array(skeletons)
+        for pose in poses:
+            expected = []
+            for skeleton in skeletons:
+                try:
+                    expected.append(pose(skeleton))
+                except TypeError:
+                    expected.append(None)
+            compiled = pose.compile()(coords)
+            self.assertEqual([None if np.isnan(score) else score for score in compiled.tolist()], expected)
+            self.assertTrue(np.isnan(compiled).any())
+
+
+class PipelineTest(unittest.TestCase):
+
+    def test_keeps_input_order(self):
+        def jitter(x):
+            time.sleep(random.random() / 1000)
+            return x
+        pipeline = Pipeline([Stage('jitter', jitter, 4, 2), Stage('square', lambda x: x * x, 3, 2)])
+        self.assertEqual(list(pipeline.run(range(200))), [x * x for x in range(200)])
+        metrics = pipeline.metrics()
+        self.assertEqual(metrics['jitter']['processed'], 200)
+        self.assertLessEqual(metrics['square']['max_depth'], 2)
+
+    def test_propagates_errors(self):
+        def fail(x):
+            if x == 5:
+                raise ValueError(x)
+            return x
+        pipeline = Pipeline([Stage('fail', fail, 2)])
+        with self.assertRaises(ValueError):
+            list(pipeline.run(range(100)))
+
+
+class DecodeKeypointsTest(unittest.TestCase):
+
+    def test_matches_min_max_loc(self):
+        out = np.random.default_rng(0).random((3, 20, 46, 46)).astype(np.float32)
+        sizes = [(640, 480), (320, 200), (1920, 1080)]
+        keypoints = decode_keypoints(out, sizes, 0.5, 16)
+        for n in range(3):
+            expected = []
+            for i in range(16):
+                _, conf, _, point = cv.minMaxLoc(out[n, i])
+                x = (sizes[n][0] * point[0]) / 46
+                y = (sizes[n][1] * point[1]) / 46
+                expected.append((int(x), int(y)) if conf > 0.5 else None)
+            self.assertEqual(keypoints.points(n), expected)
+
+    def test_refine(self):
+        (ys, xs) = np.mgrid[0:46, 0:46]
+        heatMap = np.exp(-((xs - 20.3) ** 2 + (ys - 10.8) ** 2) / 8)
+        keypoints = decode_keypoints(heatMap[None, None], [(46, 46)], refine=True)
+        self.assertAlmostEqual(keypoints.xy[0, 0, 0], 20.3, delta=0.1)
+        self.assertAlmostEqual(keypoints.xy[0, 0, 1], 10.8, delta=0.1)
+
+    def test_joint_subset(self):
+        out = np.random.default_rng(0).random((2, 16, 46, 46)).astype(np.float32)
+        sizes = [(640, 480), (320, 200)]
+        library = PoseLibrary([Body.right_arm.above(Body.head), Body.right_wrist.to_the_left(Body.neck)])
+        self.assertEqual(library.joint_ids, {'rwrist', 'relbow', 'rshoulder', 'head', 'neck'})
+        (BODY_PARTS, POSE_PAIRS) = body_tables('MPI')
+        channels = decoded_channels(BODY_PARTS, library.joint_ids)
+        self.assertEqual(channels, [0, 1, 2, 3, 4])
+        full = decode_keypoints(out, sizes, 0.5, 16)
+        subset = decode_keypoints(out, sizes, 0.5, 16, channels=channels)
+        for n in range(2):
+            self.assertEqual(subset.points(n), full.points(n)[:5] + [None] * 11)
+        with self.assertRaises(ValueError):
+            decoded_channels(BODY_PARTS, ['tail'])
+
+
+class DecodePeopleTest(unittest.TestCase):
+
+    def setUp(self):
+        (BODY_PARTS, POSE_PAIRS) = body_tables('MPI')
+        self.names = joint_names(BODY_PARTS)[:-1]
+        self.pairs = [(BODY_PARTS[a], BODY_PARTS[b]) for (a, b) in POSE_PAIRS]
+        self.pafs = paf_tables('MPI')
+
+    def person(self, ox):
+        return {'head': (ox, 4), 'neck': (ox, 8), 'rshoulder': (ox - 3, 9), 'relbow': (ox - 5, 14),
+                'rwrist': (ox - 6, 19), 'lshoulder': (ox + 3, 9), 'lelbow': (ox + 5, 14), 'lwrist': (ox + 6, 19),
+                'rhip': (ox - 2, 24), 'rknee': (ox - 2, 31), 'rankle': (ox - 2, 38), 'lhip': (ox + 2, 24),
+                'lknee': (ox + 2, 31), 'lankle': (ox + 2, 38), 'chest': (ox, 16)}
+
+    def network_output(self, people, H, W):
+        # Gaussian heatmaps on every joint and unit fields along every limb.
+        out = np.zeros((1, 44, H, W), np.float32)
+        (ys, xs) = np.mgrid[0:H, 0:W]
+        for person in people:
+            for (c, name) in enumerate(self.names):
+                (x, y) = person[name]
+                out[0, c] = np.maximum(out[0, c], np.exp(-((xs - x) ** 2 + (ys - y) ** 2) / 2))
+            for ((a, b), (cx, cy)) in zip(self.pairs, self.pafs):
+                (A, B) = (np.array(person[self.names[a]], float), np.array(person[self.names[b]], float))
+                unit = (B - A) / np.linalg.norm(B - A)
+                for t in np.linspace(0, 1, 40):
+                    (x, y) = np.rint(A + t * (B - A)).astype(int)
+                    out[0, cx, y - 1:y + 2, x - 1:x + 2] = unit[0]
+                    out[0, cy, y - 1:y + 2, x - 1:x + 2] = unit[1]
+        return out
+
+    def test_finds_every_person(self):
+        people = [self.person(8 + 12 * i) for i in range(6)]
+        out = self.network_output(people, 46, 80)
+        (skeletons,) = decode_people(out, [(160, 46)], self.names, self.pairs, self.pafs)
+        skeletons.sort(key=lambda skeleton: skeleton['head'][0])
+        expected = [{name: (2 * x, y) for (name, (x, y)) in person.items()} for person in people]
+        self.assertEqual(skeletons, expected)
+
+    def test_find_peaks(self):
+        heatMaps = np.zeros((2, 5, 5))
+        heatMaps[0, 1, 1] = heatMaps[0, 3, 4] = heatMaps[1, 2, 2] = 1
+        heatMaps[0, 1, 2] = 0.5
+        self.assertEqual(np.argwhere(find_peaks(heatMaps)).tolist(), [[0, 1, 1], [0, 3, 4], [1, 2, 2]])
+
+
+class TinyNet:
+
+    # Stands in for the Caffe network: heatmap c is the input image shifted by c pixels on
+    # both axes, so joint c of a frame holding a single dot is c steps from the dot.
+    def setInput(self, inp):
+        self.inp = inp
+
+    def forward(self):
+        image = self.inp.mean(axis=1)
+        return np.stack([np.roll(image, (c, c), axis=(1, 2)) for c in range(16)], axis=1)
+
+
+def tiny_estimator(**parameters):
+    # A PoseEstimator on a TinyNet with a 32x32 input. Module level, so that worker
+    # processes can build one too.
+    with mock.patch('pose_estimation.cv.dnn.readNetFromCaffe', lambda proto, model: TinyNet(), create=True):
+        return PoseEstimator(**{'proto': 'tiny', 'model': 'tiny', 'width': 32, 'height': 32, **parameters})
+
+
+def dot_frame(n):
+    # A 64x48 frame with a dot at a position depending on n, and that position. Joint c
+    # of the frame is expected at (x + 2c, y + 1.5c) through a TinyNet.
+    frame = np.zeros((48, 64, 3), np.uint8)
+    (x, y) = (4 + 4 * (n % 6), 6 + 3 * (n % 5))
+    cv.circle(frame, (x, y), 2, (255, 255, 255), -1)
+    return (frame, (x, y))
+
+
+class PoseEstimatorTest(unittest.TestCase):
+
+    def test_estimate(self):
+        estimator = tiny_estimator()
+        for n in range(6):
+            (frame, (x, y)) = dot_frame(n)
+            (skeleton, drawn, conf) = estimator.estimate(frame, True, True)
+            self.assertEqual(list(skeleton), [body_joints[i] for i in range(16)])
+            for (c, joint) in enumerate(MPI_JOINTS):
+                self.assertEqual(skeleton[joint], (int(x + 2 * c), int(y + 1.5 * c)))
+                self.assertGreater(conf[joint], estimator.thr)
+            self.assertEqual(drawn.shape, frame.shape)
+            self.assertFalse((drawn == frame).all())
+            self.assertEqual(estimator.estimate(frame), skeleton)
+
+    def test_estimate_batch(self):
+        # 7 frames in batches of 3, the last one short
+        estimator = tiny_estimator(batch_size=3)
+        frames = [dot_frame(n)[0] for n in range(7)]
+        calls = []
+        forward = estimator.forward
+        estimator.forward = lambda inp: calls.append(len(inp)) or forward(inp)
+        batched = estimator.estimate_batch(frames, True)
+        self.assertEqual(calls, [3, 3, 1])
+        for (frame, (skeleton, drawn)) in zip(frames, batched):
+            (expected, expectedDrawn) = estimator.estimate(frame, True)
+            self.assertEqual(skeleton, expected)
+            np.testing.assert_array_equal(drawn, expectedDrawn)
+        self.assertEqual(estimator.estimate_batch(frames, batch_size=4), [estimator.estimate(frame) for frame in frames])
+
+    def test_parameters(self):
+        estimator = tiny_estimator(thr=0.2, joints=['head', 'neck'], cache=InferenceCache(memory=3))
+        copy = tiny_estimator(**dict(zip(('proto', 'model', 'dataset', 'thr', 'width', 'height', 'batch_size', 'refine', 'joints', 'cache'),
+                                         estimator.parameters())))
+        self.assertEqual(copy.parameters(), estimator.parameters())
+        self.assertEqual((copy.joints, copy.channels, copy.cache.memory), (('head', 'neck'), [0, 1], 3))
+        skeleton = copy.estimate(dot_frame(0)[0])
+        self.assertEqual([joint for (joint, point) in skeleton.items() if point is not None], ['head', 'neck'])
+
+    def test_pose_estimation(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'frame.png')
+            (frame, point) = dot_frame(3)
+            cv.imwrite(path, frame)
+            with mock.patch('pose_estimation.cv.dnn.readNetFromCaffe', lambda proto, model: TinyNet(), create=True):
+                skeleton = pose_estimation(path, proto='tiny', model='tiny', width=32, height=32)
+                self.assertIs(shared_estimator('tiny', 'tiny', 'MPI', 0.1, 32, 32), shared_estimator('tiny', 'tiny', 'MPI', 0.1, 32, 32))
+            shared_estimator.cache_clear()
+        self.assertEqual(skeleton, tiny_estimator().estimate(frame))
+        self.assertEqual(skeleton['head'], point)
+
+
+class SkeletonTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dicts = random_skeletons(20)
+        self.dicts[0]['head'] = None
+        self.skeletons = [Skeleton.from_dict(skeleton) for skeleton in self.dicts]
+
+    def test_reads_like_dict(self):
+        skeleton = self.skeletons[0]
+        self.assertIsNone(skeleton['head'])
+        self.assertEqual(skeleton['neck'], self.dicts[0]['neck'])
+        self.assertEqual(skeleton.to_dict(), self.dicts[0])
+        self.assertEqual(Skeleton(skeleton.coords, 'MPI').get('background', 'missing'), 'missing')
+
+    def test_scores_match_dicts(self):
+        poses = [Body.right_forearm.above(Body.head) & Body.left_arm.below(Body.head),
+                 Body.left_leg.to_the_left(Body.right_calf) | ~Body.chest.above(Body.neck)]
+        for pose in poses:
+            self.assertEqual([pose(skeleton) for skeleton in self.skeletons[1:]],
+                             [pose(skeleton) for skeleton in self.dicts[1:]])
+            self.assertEqual(pose.compile()(skeletons_to_array(self.skeletons[1:])).tolist(),
+                             [pose(skeleton) for skeleton in self.dicts[1:]])
+        with self.assertRaises(TypeError):
+            Body.head.above(Body.neck)(self.skeletons[0])
+
+    def test_formats(self):
+        skeleton = Skeleton(np.zeros((25, 2)), 'BODY_25')
+        self.assertEqual(skeleton['lheel'], (0.0, 0.0))
+        self.assertIs(pickle.loads(pickle.dumps(skeleton)).format, FORMATS['BODY_25'])
+
+
+class EvaluationContextTest(unittest.TestCase):
+
+    def setUp(self):
+        self.calls = 0
+
+        def criterion(skeleton):
+            self.calls += 1
+            return skeleton['head'][1] / 400
+        self.shared = LambdaPose(criterion)
+        self.poses = [self.shared & Body.right_arm.above(Body.head), self.shared | ~Body.left_leg.below(Body.chest)]
+
+    def test_matches_direct_calls(self):
+        context = EvaluationContext()
+        for skeleton in random_skeletons(10):
+            context.reset(skeleton)
+            self.assertEqual([context(pose) for pose in self.poses], [pose(skeleton) for pose in self.poses])
+
+    def test_evaluates_shared_nodes_once(self):
+        (first, second) = random_skeletons(2)
+        context = EvaluationContext(first)
+        for pose in self.poses + self.poses:
+            context(pose)
+        self.assertEqual(self.calls, 1)
+        self.assertIs(context.resolve(Body.right_arm), context.resolve(Body.right_arm))
+        context.reset(second)
+        self.assertEqual(context(self.shared), second['head'][1] / 400)
+        self.assertEqual(self.calls, 2)
+
+
+class PoseLibraryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.poses = {
+            Body.left_arm.to_the_right(Body.left_shoulder) & Body.right_arm.to_the_left(Body.right_shoulder): 'T-pose',
+            Body.right_arm.to_the_left(Body.right_shoulder) & Body.left_wrist.to_the_left(Body.head): 'Dabbing right',
+            Body.left_arm.to_the_right(Body.left_shoulder) & Body.right_wrist.to_the_right(Body.head): 'Dabbing left',
+            ~Body.left_knee.above(Body.left_hip) | Body.right_knee.above(Body.right_hip): 'Knee',
+        }
+        self.library = PoseLibrary(self.poses)
+
+    def test_merges_shared_nodes(self):
+        # 6 distinct leaves, 1 negation and 4 roots
+        self.assertEqual(len(self.library.nodes), 11)
+        self.assertEqual(self.library.names, list(self.poses.values()))
+
+    def test_matches_poses(self):
+        skeletons = random_skeletons(30)
+        expected = [[pose(skeleton) for pose in self.poses] for skeleton in skeletons]
+        self.assertEqual([self.library(skeleton).tolist() for skeleton in skeletons], expected)
+        self.assertEqual(self.library.evaluate_batch(skeletons_to_array(skeletons)).tolist(), expected)
+
+    def test_add(self):
+        self.library.add(Body.left_arm.to_the_right(Body.left_shoulder) | Body.head.above(Body.neck), 'New')
+        self.assertEqual(len(self.library.nodes), 13)
+        self.assertEqual(len(self.library(random_skeletons(1)[0])), 5)
+
+
+class ShortCircuitTest(unittest.TestCase):
+
+    def setUp(self):
+        self.calls = 0
+
+    def counted(self, score):
+        def criterion(skeleton):
+            self.calls += 1
+            return score
+        return LambdaPose(criterion)
+
+    def test_skips_decided_operands(self):
+        self.assertEqual((self.counted(0) & self.counted(1))({}), 0)
+        self.assertEqual((self.counted(1) | self.counted(0))({}), 1)
+        self.assertEqual(self.calls, 2)
+        self.assertEqual((self.counted(0.5) & self.counted(0.25))({}), 0.25)
+        self.assertEqual(self.calls, 4)
+
+    def test_matches(self):
+        self.assertFalse((self.counted(0.5) & self.counted(1)).matches({}))
+        self.assertTrue((self.counted(0.9) | self.counted(0)).matches({}))
+        self.assertEqual(self.calls, 2)
+        pose = (Body.right_arm.above(Body.head) | ~Body.left_leg.below(Body.chest)) & Body.torso.below(Body.face)
+        for skeleton in random_skeletons(50):
+            for tolerance in (0, .3, .8, 1):
+                self.assertEqual(pose.matches(skeleton, tolerance), pose(skeleton) > tolerance)
+
+    def test_reorder_operands(self):
+        slow = LambdaPose(lambda skeleton: time.sleep(0.001) or 1)
+        pose = slow & Body.head.above(Body.neck)
+        skeletons = random_skeletons(20)
+        reordered = reorder_operands(pose, skeletons)
+        self.assertIs(reordered.second, slow)
+        self.assertEqual([reordered(skeleton) for skeleton in skeletons], [pose(skeleton) for skeleton in skeletons])
+
+
+class ClassifyTest(unittest.TestCase):
+
+    def test_matches_full_scoring(self):
+        poses = [Body.left_arm.to_the_right(Body.left_shoulder) & Body.right_arm.to_the_left(Body.right_shoulder),
+                 Body.right_forearm.above(Body.head) & Body.left_arm.below(Body.head),
+                 Body.left_knee.above(Body.left_hip) | Body.right_knee.above(Body.right_hip),
+                 ~Body.right_wrist.to_the_right(Body.left_leg) | Body.torso.below(Body.face),
+                 Body.left_leg.to_the_left(Body.right_calf) & ~Body.head.above(Body.neck),
+                 Body.head.above(Body.neck) & (Body.chest.below(Body.neck) | Body.right_arm.above(Body.left_leg))]
+        for skeleton in random_skeletons(40):
+            scores = [(pose, pose(skeleton)) for pose in poses]
+            for k in (1, 3, 6):
+                expected = sorted(scores, key=lambda item: -item[1])[:k]
+                self.assertEqual(classify(skeleton, poses, k), expected)
+
+    def test_prunes_candidates(self):
+        calls = []
+
+        def counted(name, score):
+            return LambdaPose(lambda skeleton: calls.append(name) or score)
+        poses = [counted('best', 0.9), counted('low', 0.4) & counted('pruned', 1),
+                 counted('high', 0.95) | (counted('weak', 0.2) & counted('skipped', 1))]
+        self.assertEqual([score for (pose, score) in classify({}, poses)], [0.95])
+        self.assertEqual(calls, ['best', 'low', 'high', 'weak'])
+
+
+class HashConsingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.p = Body.right_arm.above(Body.head)
+        self.q = Body.left_leg.below(Body.chest)
+
+    def test_structural_sharing(self):
+        self.assertIs(JointSelector('head'), Body.head)
+        self.assertIs(LimbSelector(['rwrist', 'relbow', 'rshoulder']), Body.right_arm)
+        self.assertIs(Body.right_arm.above(Body.head), self.p)
+        self.assertIs(self.p & self.q, AndPose(self.p, self.q))
+        self.assertNotEqual(self.p & self.q, self.q & self.p)
+        self.assertEqual(len({self.p | self.q: 'a', Body.right_arm.above(Body.head) | self.q: 'b'}), 1)
+        self.assertIs(pickle.loads(pickle.dumps(~self.p & self.q)), ~self.p & self.q)
+
+    def test_simplification(self):
+        self.assertIs(~~self.p, self.p)
+        self.assertIs(self.p & self.p, self.p)
+        self.assertIs(self.p | self.p, self.p)
+        self.assertIs(self.p | (self.q & self.p), self.p)
+        self.assertIs((self.p | self.q) & self.p, self.p)
+        self.assertIs(simplify(AndPose(OrPose(self.p, self.q), NotPose(NotPose(self.p)))), self.p)
+        self.assertEqual(repr(~self.p), f'NotPose({self.p!r})')
+
+
+class CompiledScalarTest(unittest.TestCase):
+
+    def outcome(self, function, skeleton):
+        try:
+            return function(skeleton)
+        except TypeError:
+            return TypeError
+
+    def test_matches_interpreter(self):
+        poses = [
+            Body.left_arm.to_the_right(Body.left_shoulder) & Body.right_arm.to_the_left(Body.right_shoulder),
+            (Body.right_forearm.above(Body.head) & Body.left_arm.below(Body.head)) | ~Body.head.above(Body.neck),
+            Body.left_knee.above(Body.left_hip) | Body.right_knee.above(Body.right_hip),
+            ~Body.right_wrist.to_the_right(Body.left_leg) | Body.torso.below(Body.face),
+            Body.left_leg.to_the_left(Body.right_calf) & LambdaPose(lambda skeleton: skeleton['head'][0] / 400),
+        ]
+        skeletons = random_skeletons(100) + random_skeletons(100, seed=1, integer=False)
+        rng = random.Random(2)
+        for skeleton in skeletons[::4]:
+            skeleton[rng.choice(MPI_JOINTS)] = None
+        for pose in poses:
+            function = pose.compile_scalar()
+            self.assertIs(pose.compile_scalar(), function)
+            for skeleton in skeletons:
+                self.assertEqual(self.outcome(function, skeleton), self.outcome(pose, skeleton))
+
+    def test_geometry_inlined(self):
+        # every geometry relation between joints, segments and limbs, without calling back
+        # into the parts
+        entities = [Body.head, Body.right_wrist, Body.torso, Body.right_forearm, Body.left_arm, Body.right_leg]
+        relations = [AtSameHeight, AtSameWidth, IsNear, IsFar, PointsTo, AlignedWith, Crosses, Parallel]
+        skeletons = random_skeletons(50) + random_skeletons(50, seed=1, integer=False)
+        rng = random.Random(3)
+        for skeleton in skeletons[::5]:
+            skeleton[rng.choice(MPI_JOINTS)] = None
+        for relation in relations:
+            for first in entities[2:]:
+                for second in entities:
+                    if relation is Parallel and isinstance(second, JointSelector):
+                        continue  # a joint has no bone to compare
+                    pose = relation(first, second)
+                    function = pose.compile_scalar()
+                    self.assertNotIn('(skeleton)', function.source.partition('\n')[2])
+                    for skeleton in skeletons:
+                        self.assertEqual(self.outcome(function, skeleton), self.outcome(pose, skeleton))
+
+    def test_cache_releases_poses(self):
+        pose = LambdaPose(lambda skeleton: skeleton['head'][0] / 400)
+        self.assertEqual(pose.compile_scalar()({'head': (200, 0)}), 0.5)
+        reference = weakref.ref(pose)
+        del pose
+        gc.collect()
+        self.assertIsNone(reference())
+
+    def test_function_outlives_pose(self):
+        # The function keeps the poses it calls back into.
+        score = (LambdaPose(lambda skeleton: skeleton['head'][0] / 400) & Body.head.above(Body.neck)).compile_scalar()
+        gc.collect()
+        self.assertEqual(score({'head': (200, 0), 'neck': (0, 10)}), 0.5)
+
+
+class RelationTableTest(unittest.TestCase):
+
+    def setUp(self):
+        self.entities = body_selectors()
+        self.relations = [Above, Below, ToTheRight, ToTheLeft]
+        self.skeletons = random_skeletons(10) + random_skeletons(10, seed=1, integer=False)
+
+    def test_matches_relations(self):
+        # 13 joints (the shoulders are the elbows), 14 segments and 4 limbs
+        self.assertEqual(len(self.entities), 31)
+        batch = RelationTable(skeletons_to_array(self.skeletons))
+        for (n, skeleton) in enumerate(self.skeletons):
+            table = RelationTable.from_skeleton(skeleton)
+            for relation in self.relations:
+                for first in self.entities:
+                    for second in self.entities:
+                        pose = relation(first, second)
+                        self.assertEqual(table.lookup(pose), pose(skeleton))
+                        self.assertEqual(batch.lookup(pose)[n], pose(skeleton))
+        self.assertIsNone(table.lookup(Body.head.is_near(Body.neck)))
+
+    def test_context_and_library(self):
+        poses = [
+            Body.left_arm.to_the_right(Body.left_shoulder) & Body.right_arm.to_the_left(Body.right_shoulder),
+            ~Body.left_knee.above(Body.left_hip) | Body.right_knee.above(Body.right_hip),
+            Body.right_forearm.above(Body.head) & LambdaPose(lambda skeleton: 0.5),
+        ]
+        library = PoseLibrary(poses, relations=True)
+        expected = [[pose(skeleton) for pose in poses] for skeleton in self.skeletons]
+        self.assertEqual([[pose(EvaluationContext(skeleton, relations=True)) for pose in poses]
+                          for skeleton in self.skeletons], expected)
+        self.assertEqual([library(skeleton).tolist() for skeleton in self.skeletons], expected)
+        self.assertEqual(library.evaluate_batch(skeletons_to_array(self.skeletons)).tolist(), expected)
+        # Only the relation leaves of the library are in its table.
+        layout = library.relation_layout()
+        self.assertEqual((len(layout), len(layout.entities)), (5, 10))
+        table = RelationTable.from_skeleton(self.skeletons[0], layout)
+        self.assertEqual(table.values.shape, (5,))
+        self.assertIsNone(table.lookup(Body.head.above(Body.neck)))
+        library.add(Body.head.above(Body.neck))
+        self.assertEqual(len(library.relation_layout()), 6)
+
+    def test_missing_joints(self):
+        skeleton = random_skeletons(1)[0]
+        skeleton['head'] = None
+        self.assertTrue(math.isnan(RelationTable.from_skeleton(skeleton).lookup(Body.head.above(Body.neck))))
+        with self.assertRaises(TypeError):
+            Body.head.above(Body.neck)(EvaluationContext(skeleton, relations=True))
+
+
+class PoseStreamTest(unittest.TestCase):
+
+    def setUp(self):
+        self.raised = LambdaPose(lambda skeleton: skeleton.get('raised') + 0)
+        self.crouched = LambdaPose(lambda skeleton: skeleton.get('crouched') + 0)
+        self.poses = {self.raised: 'Raised', self.crouched: 'Crouched'}
+
+    def frames(self, **scores):
+        return [{name: score for (name, score) in zip(scores, frame)} for frame in zip(*scores.values())]
+
+    def test_hysteresis(self):
+        stream = PoseStream(self.poses, alpha=1, on=0.8, off=0.6)
+        frames = self.frames(raised=[0, 0.9, 0.7, 0.85, 0.5, 0.7], crouched=[1, 1, 1, 0.65, 0.6, 0])
+        events = list(stream.events(frames))
+        self.assertEqual([(event.kind, event.name, event.frame) for event in events],
+                         [('started', 'Crouched', 0), ('started', 'Raised', 1), ('ended', 'Raised', 4), ('ended', 'Crouched', 4)])
+        self.assertEqual(stream.state(), {'Raised': (0.7, False), 'Crouched': (0.0, False)})
+
+    def test_smoothing(self):
+        stream = PoseStream(self.poses, alpha=0.5)
+        # a single frame spike does not start the pose, a lasting one does
+        events = [stream.update({'raised': score, 'crouched': 0}) for score in [0, 1, 0, 0, 1, 1, 1]]
+        self.assertEqual([len(frame) for frame in events], [0, 0, 0, 0, 0, 0, 1])
+        self.assertEqual(events[-1], [PoseEvent('started', self.raised, 'Raised', 6, 0.875)])
+
+    def test_missing_skeleton(self):
+        stream = PoseStream(self.poses, alpha=1)
+        self.assertEqual(len(stream.update({'raised': 1, 'crouched': 0})), 1)
+        self.assertEqual(stream.update({'raised': None, 'crouched': 0}), [])
+        self.assertEqual(stream.frame, 2)
+        self.assertEqual(stream.state()['Raised'], (1.0, True))
+
+
+class GestureMatcherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.raised = LambdaPose(lambda skeleton: skeleton['raised'])
+        self.lowered = LambdaPose(lambda skeleton: skeleton['lowered'])
+        self.tpose = LambdaPose(lambda skeleton: skeleton['tpose'])
+
+    def frames(self, timeline):
+        # one frame per character: r raised, l lowered, t T-pose, anything else none of them
+        return [{'raised': c == 'r', 'lowered': c == 'l', 'tpose': c == 't'} for c in timeline]
+
+    def match(self, gestures, timeline):
+        matcher = GestureMatcher(gestures, fps=10)
+        return [(match.name, round(match.start, 3), round(match.end, 3)) for match in matcher.matches(self.frames(timeline))]
+
+    def test_held_for(self):
+        gestures = {gesture(self.tpose).held_for(2): 'T-pose held'}
+        self.assertEqual(self.match(gestures, 't' * 25 + '.' * 5 + 't' * 15), [('T-pose held', 0, 2)])
+
+    def test_then_within(self):
+        gestures = {gesture(self.raised).then(self.lowered).within(1): 'Wave'}
+        self.assertEqual(self.match(gestures, 'rrrrrllll'), [('Wave', 0, 0.5)])
+        self.assertEqual(self.match(gestures, 'rrrrr' + '.' * 15 + 'llll'), [])
+        self.assertEqual(self.match(gestures, 'rrr.....lrr..l'), [('Wave', 0, 0.8), ('Wave', 0.9, 1.3)])
+        self.assertEqual(self.match(gestures, 'lllrrrll'), [('Wave', 0.3, 0.6)])
+
+    def test_chains(self):
+        wave = gesture(self.raised).held_for(0.2).then(self.lowered, within=0.5).then(gesture(self.raised).held_for(0.3))
+        gestures = {wave: 'Wave', gesture(self.raised): 'Raised'}
+        self.assertEqual(len(wave), 3)
+        self.assertEqual(self.match(gestures, 'rr..l.rrrr'), [('Raised', 0, 0), ('Raised', 0.6, 0.6)])
+        self.assertEqual(self.match(gestures, 'rrr.l.rrrr'), [('Raised', 0, 0), ('Raised', 0.6, 0.6), ('Wave', 0, 0.9)])
+        with self.assertRaises(ValueError):
+            gesture(self.raised).within(1)
+
+
+class IncrementalEvaluatorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.poses = {
+            Body.left_arm.to_the_right(Body.left_shoulder) & Body.right_arm.to_the_left(Body.right_shoulder): 'T-pose',
+            Body.right_forearm.above(Body.head) & Body.left_arm.below(Body.head): 'Right hand raised',
+            ~Body.left_knee.above(Body.left_hip) | Body.right_knee.above(Body.right_hip): 'Knee',
+            Body.right_wrist.is_near(Body.face): 'Thinking',
+        }
+        self.evaluator = IncrementalEvaluator(self.poses)
+
+    def walk(self, count, seed=0):
+        # a skeleton where a few joints move at every frame
+        rng = random.Random(seed)
+        skeleton = random_skeletons(1, seed)[0]
+        for _ in range(count):
+            skeleton = dict(skeleton)
+            for joint in rng.sample(MPI_JOINTS, rng.randint(0, 3)):
+                (x, y) = skeleton[joint]
+                skeleton[joint] = (x + rng.randint(-20, 20), y + rng.randint(-20, 20))
+            yield skeleton
+
+    def test_joints(self):
+        self.assertEqual(Body.right_arm.above(Body.head).joints(), {'rwrist', 'relbow', 'rshoulder', 'head'})
+        self.assertEqual((~Body.head.is_near(Body.neck)).joints(), {'head', 'neck', 'rhip', 'lhip'})
+        self.assertIsNone((Body.head.above(Body.neck) | LambdaPose(len)).joints())
+
+    def test_matches_library(self):
+        for skeleton in self.walk(200):
+            self.assertEqual(self.evaluator(skeleton).tolist(), self.evaluator.library(skeleton).tolist())
+
+    def test_skips_still_joints(self):
+        skeleton = random_skeletons(1)[0]
+        self.evaluator(skeleton)
+        self.assertEqual(self.evaluator.evaluated, len(self.evaluator.library.nodes))
+        self.evaluator(Skeleton.from_dict(skeleton))
+        self.assertEqual(self.evaluator.evaluated, 0)
+        (x, y) = skeleton['lknee']
+        skeleton['lknee'] = (x, y + 1)
+        self.evaluator(skeleton)
+        self.assertIn(self.evaluator.evaluated, (1, 2, 3))
+
+    def test_epsilon(self):
+        evaluator = IncrementalEvaluator(self.poses, epsilon=5)
+        skeleton = random_skeletons(1)[0]
+        expected = evaluator(skeleton).tolist()
+        # drifting by 2 per frame is only caught once it adds up to more than 5
+        for step in range(1, 4):
+            skeleton = {joint: (x + 2, y) for (joint, (x, y)) in skeleton.items()}
+            evaluator(skeleton)
+            self.assertEqual(evaluator.evaluated > 0, step == 3)
+        self.assertEqual(evaluator(skeleton).tolist(), self.evaluator.library(skeleton).tolist())
+
+    def test_missing_joint(self):
+        skeleton = random_skeletons(1)[0]
+        self.evaluator(skeleton)
+        with self.assertRaises(TypeError):
+            self.evaluator({**skeleton, 'head': None})
+        self.assertEqual(self.evaluator(skeleton).tolist(), self.evaluator.library(skeleton).tolist())
+
+    def test_growing_library(self):
+        library = PoseLibrary()
+        evaluator = IncrementalEvaluator(library)
+        skeleton = random_skeletons(1)[0]
+        self.assertEqual(evaluator(skeleton).tolist(), [])
+        library.add(Body.head.above(Body.neck))
+        library.add(Body.left_knee.above(Body.left_hip) | Body.head.above(Body.neck))
+        self.assertEqual(evaluator(skeleton).tolist(), library(skeleton).tolist())
+        skeleton = {**skeleton, 'lknee': (0, 0)}
+        self.assertEqual(evaluator(skeleton).tolist(), library(skeleton).tolist())
+
+
+class SkeletonStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'store')
+        self.skeletons = random_skeletons(40)
+        self.skeletons[3]['head'] = None
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_append_and_reopen(self):
+        with SkeletonStore(self.path) as store:
+            for (i, skeleton) in enumerate(self.skeletons[:25]):
+                store.append(i, i / 25, skeleton)
+            self.assertEqual(len(store), 25)
+        with SkeletonStore(self.path) as store:
+            store.extend(range(25, 40), [i / 25 for i in range(25, 40)], skeletons_to_array(self.skeletons[25:]))
+            self.assertEqual(len(store), 40)
+            self.assertEqual(store.frames.tolist(), list(range(40)))
+            self.assertEqual(store.times[30], 30 / 25)
+            np.testing.assert_array_equal(store.coords, skeletons_to_array(self.skeletons))
+            self.assertIsNone(store.skeleton(3)['head'])
+            self.assertTrue(np.isnan(store.conf).all())
+
+    def test_evaluate(self):
+        poses = [Body.left_arm.to_the_right(Body.left_shoulder) & Body.right_arm.to_the_left(Body.right_shoulder),
+                 Body.right_wrist.is_near(Body.head) | ~Body.left_leg.straight()]
+        skeletons = [skeleton for skeleton in self.skeletons if skeleton['head'] is not None]
+        with SkeletonStore(self.path) as store:
+            store.extend(range(len(skeletons)), range(len(skeletons)), skeletons_to_array(skeletons))
+            expected = [[pose(skeleton) for pose in poses] for skeleton in skeletons]
+            self.assertEqual(store.evaluate(PoseLibrary(poses), chunk=7).tolist(), expected)
+            self.assertEqual(store.evaluate(poses[0], chunk=7).tolist(), [scores[0] for scores in expected])
+            self.assertEqual([poses[0](skeleton) for skeleton in store], [scores[0] for scores in expected])
+
+    def test_confidences(self):
+        estimator = object.__new__(PoseEstimator)
+        (estimator.BODY_PARTS, estimator.POSE_PAIRS) = body_tables('MPI')
+        conf = np.linspace(0, 1, 16)
+        conf[1] = -np.inf
+        (skeleton, joints) = estimator.result(None, [(1, 2)] * 16, False, conf)
+        self.assertEqual(joints['rshoulder'], conf[2])
+        with SkeletonStore(self.path) as store:
+            store.append(0, 0, skeleton, joints)
+            store.append(1, 0.04, skeleton)
+            np.testing.assert_array_equal(store.conf[0], np.where(np.isinf(conf), np.nan, conf)[:15].astype(np.float32))
+            self.assertTrue(np.isnan(store.conf[1]).all())
+
+    def test_partial_row(self):
+        with SkeletonStore(self.path) as store:
+            store.extend([0, 1], [0, 1], skeletons_to_array(self.skeletons[:2]))
+        with open(os.path.join(self.path, 'xy.f4'), 'ab') as file:
+            file.write(b'\0' * 12)
+        self.assertEqual(len(SkeletonStore(self.path)), 2)
+
+    def test_format(self):
+        SkeletonStore(self.path, 'COCO').close()
+        store = SkeletonStore(self.path)
+        self.assertEqual(store.format.name, 'COCO')
+        self.assertEqual(len(store), 0)
+        self.assertEqual(store.coords.shape, (0, 18, 2))
+
+
+class InferenceCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.blobs = np.random.default_rng(0).random((6, 3, 8, 8)).astype(np.float32)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_memory_tier(self):
+        cache = InferenceCache(memory=2)
+        keys = [cache.key(blob, ('model', 368)) for blob in self.blobs[:3]]
+        self.assertNotEqual(cache.key(self.blobs[0], ('model', 368)), cache.key(self.blobs[0], ('model', 256)))
+        for (key, blob) in zip(keys, self.blobs):
+            self.assertIsNone(cache.get(key))
+            cache.put(key, blob)
+        self.assertIsNone(cache.get(keys[0]))
+        np.testing.assert_array_equal(cache.get(keys[2]), self.blobs[2])
+        self.assertEqual((cache.hits, cache.misses), (1, 4))
+
+    def test_quantize(self):
+        cache = InferenceCache(quantize=64)
+        blob = np.rint(self.blobs[0] * 64) / 64
+        noisy = blob + np.float32(1e-3)
+        self.assertEqual(cache.key(noisy), cache.key(blob))
+        self.assertNotEqual(InferenceCache().key(noisy), InferenceCache().key(blob))
+
+    def test_disk_tier(self):
+        size = self.blobs[0].nbytes + 128
+        cache = InferenceCache(self.directory.name, memory=1, disk=3 * size)
+        keys = [cache.key(blob) for blob in self.blobs]
+        for (key, blob) in zip(keys, self.blobs):
+            cache.put(key, blob)
+            time.sleep(0.01)
+        self.assertLessEqual(cache.disk_size, 3 * size)
+        reopened = InferenceCache(self.directory.name, memory=1, disk=3 * size)
+        self.assertIsNone(reopened.get(keys[0]))
+        np.testing.assert_array_equal(reopened.get(keys[5]), self.blobs[5])
+        self.assertEqual(reopened.stats()['disk_hits'], 1)
+
+    def test_disk_eviction(self):
+        # files are evicted least recently used first, a disk hit counting as a use,
+        # without listing the directory again
+        size = self.blobs[0].nbytes + 128
+        cache = InferenceCache(self.directory.name, memory=1, disk=3 * size)
+        keys = [cache.key(blob) for blob in self.blobs]
+        for (key, blob) in zip(keys[:3], self.blobs):
+            cache.put(key, blob)
+        with mock.patch('pose_cache.os.scandir', side_effect=AssertionError('directory listed')):
+            np.testing.assert_array_equal(cache.get(keys[0]), self.blobs[0])
+            for (key, blob) in zip(keys[3:5], self.blobs[3:5]):
+                cache.put(key, blob)
+        self.assertEqual(sorted(os.listdir(self.directory.name)), sorted(key + '.npy' for key in [keys[0]] + keys[3:5]))
+        self.assertEqual(cache.disk_size, sum(os.path.getsize(file) for file in cache.files()))
+
+    def test_estimator(self):
+        class Net:
+            calls = []
+            def setInput(self, inp):
+                self.inp = inp
+            def forward(self):
+                self.calls.append(len(self.inp))
+                return self.inp[:, :2] * 2
+        estimator = PoseEstimator.__new__(PoseEstimator)
+        (estimator.proto, estimator.model, estimator.width, estimator.height) = ('proto', 'model', 8, 8)
+        estimator.net = Net()
+        estimator.cache = InferenceCache()
+        first = estimator.forward(self.blobs[:4])
+        second = estimator.forward(self.blobs[2:])
+        np.testing.assert_array_equal(first, self.blobs[:4, :2] * 2)
+        np.testing.assert_array_equal(second, self.blobs[2:, :2] * 2)
+        self.assertEqual(Net.calls, [4, 2])
+        self.assertEqual(estimator.cache.stats()['hits'], 2)
+        # a static camera: the same image several times in one batch goes through once
+        still = estimator.forward(self.blobs[[0, 0, 5, 0, 5]] + 1)
+        np.testing.assert_array_equal(still, (self.blobs[[0, 0, 5, 0, 5], :2] + 1) * 2)
+        self.assertEqual(Net.calls, [4, 2, 2])
+
+    def test_parameters(self):
+        cache = InferenceCache(self.directory.name, memory=4, disk=1 << 20, quantize=32)
+        copy = InferenceCache(*cache.parameters())
+        self.assertEqual(repr(copy), repr(cache))
+        cache.put(cache.key(self.blobs[0]), self.blobs[0])
+        np.testing.assert_array_equal(copy.get(copy.key(self.blobs[0])), self.blobs[0])
+
+
+class ShiftEstimator(PoseEstimator):
+
+    # Knows where the joints are on frames of a texture moving right by `speed` pixels a
+    # frame, finding them with confidence `conf`, and counts how many frames it estimates.
+    def __init__(self, frames, speed, conf=1):
+        self.thr = 0.1
+        self.conf = conf
+        (self.BODY_PARTS, self.POSE_PAIRS) = body_tables('MPI')
+        self.frames = frames
+        self.speed = speed
+        self.base = np.random.default_rng(1).uniform(60, 140, (16, 2))
+        self.calls = 0
+
+    def truth(self, frame):
+        n = next(i for (i, other) in enumerate(self.frames) if other is frame)
+        return self.base + [n * self.speed, 0]
+
+    def keypoint_batches(self, frames, batch_size=None):
+        self.calls += len(frames)
+        xy = np.stack([self.truth(frame) for frame in frames])
+        conf = np.full(xy.shape[:2], self.conf, dtype=float)
+        conf[:, 15] = 0
+        yield (frames, Keypoints(xy, conf, self.thr))
+
+    def estimate(self, frame, retframe=False):
+        ((batch, keypoints),) = self.keypoint_batches([frame])
+        return self.result(frame, keypoints.points(0), retframe)
+
+
+class KeyframeEstimatorTest(unittest.TestCase):
+
+    def setUp(self):
+        texture = cv.GaussianBlur(np.random.default_rng(0).integers(0, 255, (200, 240, 3), dtype=np.uint8), (7, 7), 2)
+        self.frames = [np.roll(texture, 2 * n, axis=1) for n in range(12)]
+        self.estimator = ShiftEstimator(self.frames, 2)
+
+    def test_tracks_between_keyframes(self):
+        keyframed = KeyframeEstimator(self.estimator, stride=4)
+        for frame in self.frames:
+            skeleton = keyframed.estimate(frame)
+            truth = self.estimator.truth(frame)
+            for (i, joint) in enumerate(MPI_JOINTS):
+                self.assertLessEqual(np.abs(np.subtract(skeleton[joint], truth[i])).max(), 2)
+            self.assertIsNone(skeleton['background'])
+        self.assertEqual((keyframed.keyframes, keyframed.tracked, self.estimator.calls), (3, 9, 3))
+
+    def test_confidence_decay(self):
+        keyframed = KeyframeEstimator(self.estimator, stride=12, decay=0.5)
+        confs = [keyframed.estimate(frame, False, True)[1]['head'] for frame in self.frames[:6]]
+        # 0.5 ** 4 would be under the 0.1 threshold, so the fifth frame is a keyframe
+        self.assertEqual(confs, [1, 0.5, 0.25, 0.125, 1, 0.5])
+        self.assertEqual(keyframed.keyframes, 2)
+
+    def test_weak_joints_fade_out(self):
+        # joints found under confident are dropped without forcing keyframes
+        self.estimator.conf = 0.3
+        keyframed = KeyframeEstimator(self.estimator, stride=12, decay=0.5)
+        skeletons = [keyframed.estimate(frame) for frame in self.frames[:6]]
+        self.assertEqual(keyframed.keyframes, 1)
+        self.assertEqual([skeleton['head'] is None for skeleton in skeletons], [False, False, True, True, True, True])
+        keyframed = KeyframeEstimator(self.estimator, stride=12, decay=0.5, confident=0.3)
+        for frame in self.frames[:6]:
+            keyframed.estimate(frame)
+        self.assertEqual(keyframed.keyframes, 3)
+
+    def test_motion(self):
+        # a black frame is a keyframe, and so is the next one
+        self.frames[6] = np.zeros_like(self.frames[6])
+        keyframed = KeyframeEstimator(self.estimator, stride=100, motion=0.2)
+        for frame in self.frames:
+            keyframed.estimate(frame)
+        self.assertEqual(keyframed.keyframes, 3)
+
+    def test_report(self):
+        report = keyframe_report(self.frames, self.estimator, PoseLibrary([Body.right_arm.above(Body.head)]), stride=3)
+        self.assertEqual((report['frames'], report['keyframes']), (12, 4))
+        self.assertEqual(report['recall'], 1.0)
+        self.assertLess(report['mean_error'], 1)
+        self.assertLess(report['score_error'], 0.1)
+
+    def test_report_without_cache(self):
+        # neither run is served from the estimator's cache, which is put back afterwards
+        cache = InferenceCache(memory=16)
+        estimator = tiny_estimator(cache=cache)
+        frames = [dot_frame(n)[0] for n in range(6)]
+        for frame in frames:
+            estimator.estimate(frame)
+        misses = cache.misses
+        report = keyframe_report(frames, estimator, stride=3)
+        self.assertEqual(report['frames'], 6)
+        self.assertEqual((cache.hits, cache.disk_hits, cache.misses), (0, 0, misses))
+        self.assertIs(estimator.cache, cache)
+
+
+class DemoTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.video = self.path('input.avi')
+        writer = cv.VideoWriter(self.video, cv.VideoWriter_fourcc(*'MJPG'), 10, (64, 48))
+        for n in range(13):
+            writer.write(dot_frame(n)[0])
+        writer.release()
+        self.frames = list(pose_demo.read_frames(self.video))
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def path(self, name):
+        return os.path.join(self.directory.name, name)
+
+    def read(self, path):
+        return list(pose_demo.read_frames(path))
+
+    def check_results(self, results):
+        estimator = tiny_estimator()
+        self.assertEqual(len(results), len(self.frames))
+        for ((skeleton, scores), frame) in zip(results, self.frames):
+            expected = estimator.estimate(frame)
+            self.assertEqual(skeleton.to_dict(), Skeleton.from_dict(expected).to_dict())
+            self.assertEqual(scores, pose_demo.LIBRARY.scores(expected))
+
+    def test_frames_to_vid_from_iterator(self):
+        count = pose_demo.frames_to_vid(10, self.path('frames.avi'), iter(self.frames), 'MJPG')
+        self.assertEqual(count, 13)
+        written = self.read(self.path('frames.avi'))
+        self.assertEqual([frame.shape for frame in written], [(48, 64, 3)] * 13)
+        # Each written frame is closest to the frame it was written from.
+        distances = [[np.abs(frame.astype(float) - original).mean() for original in self.frames] for frame in written]
+        self.assertEqual([int(np.argmin(row)) for row in distances], list(range(13)))
+        self.assertEqual(pose_demo.frames_to_vid(10, self.path('empty.avi'), iter([])), 0)
+        self.assertFalse(os.path.exists(self.path('empty.avi')))
+
+    def test_frames_to_vid_from_files(self):
+        for (i, frame) in enumerate(self.frames[:5]):
+            cv.imwrite(self.path(f'frame{i}.jpg'), frame)
+        self.assertEqual(pose_demo.frames_to_vid(10, self.path('files.avi'), self.path('frame')), 5)
+        self.assertEqual(len(self.read(self.path('files.avi'))), 5)
+
+    def test_store_needs_every_joint(self):
+        # joints given to the demo or to its estimator are both refused with a store
+        store = self.path('skeletons.npz')
+        for options in [{'joints': ('head',)}, {'estimator': tiny_estimator(joints=('head',))},
+                        {'estimator': tiny_estimator(joints=('head',)), 'keyframes': {'stride': 2}}]:
+            with self.assertRaises(ValueError):
+                pose_demo.demo(self.video, self.path('output.avi'), storePath=store, **options)
+        self.assertFalse(os.path.exists(store))
+        self.assertFalse(os.path.exists(self.path('output.avi')))
+
+    def test_streaming_demo(self):
+        results = pose_demo.demo(self.video, self.path('output.avi'), treatedFrames=self.path('treated'), estimator=tiny_estimator())
+        self.check_results(results)
+        rendered = self.read(self.path('output.avi'))
+        self.assertEqual(len(rendered), 13)
+        self.assertEqual(rendered[0].shape, (48, 64 + 1000, 3))
+        self.assertEqual(len(list(pose_demo.read_frame_files(self.path('treated')))), 13)
+
+    def test_parallel_demo(self):
+        # 5 chunks of at most 3 frames over 2 workers, reassembled in frame order.
+        results = pose_demo.parallel_demo(self.video, self.path('output.avi'), 2, treatedFrames=self.path('treated'),
+                                          estimatorParameters=tiny_estimator().parameters(), chunkSize=3,
+                                          estimatorFactory=tiny_estimator)
+        self.check_results(results)
+        self.assertEqual(len(self.read(self.path('output.avi'))), 13)
+        self.assertEqual(len(list(pose_demo.read_frame_files(self.path('treated')))), 13)
+
+    def test_chunk_treatment_joints(self):
+        # joints replaces the one of the parameters, given by position up to joints.
+        parameters = tiny_estimator(joints=('head', 'neck')).parameters()
+        treated = pose_demo.chunk_treatment(self.frames[4:6], 4, parameters, joints=('head',),
+                                            estimatorFactory=tiny_estimator)
+        expected = tiny_estimator(joints=('head',))
+        self.assertEqual([skeleton.to_dict() for (rendered, skeleton, conf, scores) in treated],
+                         [Skeleton.from_dict(expected.estimate(frame)).to_dict() for frame in self.frames[4:6]])
+        self.assertEqual([conf for (rendered, skeleton, conf, scores) in treated],
+                         [expected.estimate(frame, retconf=True)[1] for frame in self.frames[4:6]])
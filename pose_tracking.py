@@ -0,0 +1,131 @@
+import time
+import cv2 as cv
+import numpy as np
+
+
+class KeyframeEstimator:
+
+    # Wraps a PoseEstimator to run the network on keyframes only. A frame is a keyframe
+    # every `stride` frames, or sooner once it differs from the last keyframe by more than
+    # `motion` (mean absolute difference of the grayscale frames, between 0 and 1). On the
+    # frames in between, joints are carried over by sparse Lucas-Kanade optical flow from
+    # the previous frame, and their confidence is their keyframe confidence times `decay`
+    # per frame since the keyframe. A joint is dropped once the flow loses it or its
+    # confidence falls under the estimator's threshold. When that happens to a joint found
+    # with a confidence of at least `confident` on the keyframe, the frame is a keyframe as
+    # well; weaker joints, like many MPI joints at 0.1-0.3, just fade out, rather than
+    # shortening the stride to a frame or two. Frames must be given in order, which makes it
+    # usable anywhere frames are estimated one after the other, e.g.
+    # pose_demo.estimate_frames.
+    def __init__(self, estimator, stride=5, motion=None, decay=0.9, window=21, levels=3, confident=0.5):
+        self.estimator = estimator
+        self.stride = stride
+        self.motion = motion
+        self.decay = decay
+        self.confident = confident
+        self.window = window
+        self.levels = levels
+        self.reset()
+
+    def reset(self):
+        self.gray = None
+        self.keyGray = None
+        self.points = None
+        self.keyConf = None
+        self.lost = None
+        self.conf = None
+        self.since = 0
+        self.keyframes = 0
+        self.tracked = 0
+
+    def __repr__(self):
+        return f'KeyframeEstimator({self.estimator.__repr__()}, stride={self.stride}, motion={self.motion}, decay={self.decay}, confident={self.confident})'
+
+    def is_keyframe(self, gray):
+        if self.keyGray is None or self.since >= self.stride or self.points is None:
+            return True
+        confident = (self.keyConf > self.estimator.thr) & (self.keyConf >= self.confident)
+        if (confident & (self.lost | (self.keyConf * self.decay ** self.since <= self.estimator.thr))).any():
+            return True
+        if self.motion is not None:
+            return cv.absdiff(gray, self.keyGray).mean() / 255 > self.motion
+        return False
+
+    def estimate(self, frame, retframe=False, retconf=False):
+        gray = cv.cvtColor(frame, cv.COLOR_BGR2GRAY) if frame.ndim == 3 else frame
+        if self.is_keyframe(gray):
+            ((batch, keypoints),) = self.estimator.keypoint_batches([frame], 1)
+            self.points = keypoints.xy[0].astype(np.float32)
+            self.keyConf = np.where(keypoints.found[0], keypoints.conf[0], 0).astype(np.float32)
+            self.lost = np.zeros(len(self.keyConf), dtype=bool)
+            self.keyGray = gray
+            self.since = 0
+            self.keyframes += 1
+        else:
+            self.track(gray)
+            self.tracked += 1
+        self.conf = np.where(self.lost, 0, self.keyConf * self.decay ** self.since).astype(np.float32)
+        self.gray = gray
+        self.since += 1
+        return self.estimator.result(frame, self.current(), retframe, self.conf if retconf else None)
+
+    def track(self, gray):
+        found = np.flatnonzero((self.keyConf > self.estimator.thr) & ~self.lost)
+        if len(found):
+            (moved, status, error) = cv.calcOpticalFlowPyrLK(
+                self.gray, gray, self.points[found].reshape(-1, 1, 2), None,
+                winSize=(self.window, self.window), maxLevel=self.levels)
+            self.points[found] = moved.reshape(-1, 2)
+            self.lost[found[status.ravel() == 0]] = True
+
+    def current(self):
+        # The points of the frame as decoded by the estimator, None for joints not found.
+        xy = self.points.astype(int).tolist()
+        return [tuple(point) if conf > self.estimator.thr else None for (point, conf) in zip(xy, self.conf.tolist())]
+
+
+def keyframe_report(frames, estimator, library=None, **options):
+    # Accuracy versus speed of KeyframeEstimator(estimator, **options) against full
+    # inference on every frame of the same clip. Joint error is in pixels, over the joints
+    # found by both; with a PoseLibrary, scores are compared on the frames both score.
+    # The estimator's InferenceCache is set aside meanwhile: the keyframes would otherwise
+    # be served from what the full run just cached, and both runs from earlier ones.
+    frames = list(frames)
+    cache = getattr(estimator, 'cache', None)
+    if cache is not None:
+        estimator.cache = None
+    try:
+        start = time.perf_counter()
+        full = [estimator.estimate(frame) for frame in frames]
+        fullTime = time.perf_counter() - start
+        keyframed = KeyframeEstimator(estimator, **options)
+        start = time.perf_counter()
+        fast = [keyframed.estimate(frame) for frame in frames]
+        fastTime = time.perf_counter() - start
+    finally:
+        if cache is not None:
+            estimator.cache = cache
+
+    errors = []
+    (bothFound, fullFound) = (0, 0)
+    scoreErrors = []
+    for (expected, skeleton) in zip(full, fast):
+        for (joint, point) in expected.items():
+            if point is None:
+                continue
+            fullFound += 1
+            if skeleton.get(joint) is not None:
+                bothFound += 1
+                errors.append(np.hypot(point[0] - skeleton[joint][0], point[1] - skeleton[joint][1]))
+        if library is not None:
+            try:
+                scoreErrors.append(np.abs(library.evaluate(expected) - library.evaluate(skeleton)).mean())
+            except TypeError:
+                pass
+    return {'frames': len(frames), 'keyframes': keyframed.keyframes,
+            'full_time': fullTime, 'keyframe_time': fastTime,
+            'speedup': fullTime / fastTime if fastTime else float('inf'),
+            'mean_error': float(np.mean(errors)) if errors else 0.0,
+            'max_error': float(np.max(errors)) if errors else 0.0,
+            'recall': bothFound / fullFound if fullFound else 1.0,
+            'score_error': float(np.mean(scoreErrors)) if scoreErrors else None}